@@ -0,0 +1,160 @@
+# A binary column store for the train data of a run: one .npy array per
+# column and a schema.txt file listing the columns, their types and files.
+# simulator.py --sink columns and dbToFile.py --columns write it, loadColumns
+# memory-maps it, so reading a column is a zero-copy numpy view of the file
+# instead of parsing the text of a train file.
+# example:
+#   import columnStore
+#   train = columnStore.loadColumns('/tmp/2015_08_10_19_34_7597/train2_3.columns')
+#   train['bmv'], train['visit_date'], train['sub_id'] ...
+
+import os
+import struct
+from collections import OrderedDict
+import numpy as np
+
+schemaFile = "schema.txt"
+
+def columnType(name, string_columns = ()): #{{{
+    """
+    The numpy type of a column, following the column types createTable in
+    simulator.py gives the run tables: *id columns are integers, versions
+    and parameter set names are strings (varchar(50)) and everything else
+    is a double. A column is only a version if its name ends with
+    'version', so seroconversion_date is a double.
+    Parameters can be strings too (e.g. dist = 'normal' of biology 4), the
+    columns in string_columns (see stringParameters) are strings.
+    """
+    if name.count("id") == 1:
+        return np.dtype('<i8')
+    elif (name.endswith("version") or name in ("prot_param_set", "bio_param_set")
+            or name in string_columns):
+        return np.dtype('S50')
+    else:
+        return np.dtype('<f8')
+    #}}}
+
+def stringParameters(cursor): #{{{
+    """
+    The names of the parameters with a varchar type in the
+    biology_parameter_sets or protocol_parameter_sets table of a database
+    """
+    names = set()
+    for table in ("biology_parameter_sets", "protocol_parameter_sets"):
+        cursor.execute("SELECT DISTINCT variable, type FROM %s" %table)
+        for variable, vartype in cursor.fetchall():
+            if str(vartype).lower().startswith("varchar"):
+                names.add(variable)
+    return names
+    #}}}
+
+dumpStringColumns = {}
+
+def dumpStringParameters(dump = None): #{{{
+    """
+    stringParameters of the parameter sets in a MySQL dump, by default the
+    acs_no_sims_20150810.sql dump the sqlite databases are seeded from
+    """
+    if dump not in dumpStringColumns:
+        import sqliteDB
+        db = sqliteDB.connect(":memory:", dump)
+        dumpStringColumns[dump] = stringParameters(db.cursor())
+        db.close()
+    return dumpStringColumns[dump]
+    #}}}
+
+def npyHeader(dtype, nrows): #{{{
+    """
+    A version 1.0 .npy header for a 1 dimensional array. It is always
+    padded to 128 bytes so that it can be rewritten in place with the final
+    number of rows once the column has been written.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" %(
+            np.lib.format.dtype_to_descr(dtype), nrows)
+    header = header.ljust(128 - 10 - 1) + "\n"
+    return "\x93NUMPY\x01\x00" + struct.pack('<H', len(header)) + header
+    #}}}
+
+def columnValues(values, dtype): #{{{
+    values = np.array(values, dtype = object)
+    nulls = np.array([v is None for v in values], dtype = bool)
+    if dtype.kind == 'f':
+        values[nulls] = np.nan
+    elif dtype.kind == 'S':
+        values[nulls] = "\\N"
+    return values.astype(dtype)
+    #}}}
+
+class ColumnStoreWriter(object): #{{{
+    """
+    Writes rows to a column store in directory. The rows are appended to
+    the column files as they come in, so the store can be written in
+    constant memory. The column types are those of columnType.
+    """
+
+    def __init__(self, directory, header, string_columns = ()):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.header = list(header)
+        self.dtypes = [columnType(name, string_columns) for name in self.header]
+        self.files = []
+        for name, dtype in zip(self.header, self.dtypes):
+            f = open(os.path.join(directory, name + ".npy"), 'wb')
+            f.write(npyHeader(dtype, 0))
+            self.files.append(f)
+        self.nrows = 0
+
+    def append_rows(self, rows):#{{{
+        """
+        rows is a list of rows, each with a value for every column. All the
+        columns are converted before any is written, so rows that do not
+        fit the column types leave the store as it was.
+        """
+        if len(rows) == 0:
+            return
+        columns = [columnValues(column, self.dtypes[i]) for i, column in enumerate(zip(*rows))]
+        for f, column in zip(self.files, columns):
+            column.tofile(f)
+        self.nrows += len(rows)
+        #}}}
+
+    def close(self):#{{{
+        for f, dtype in zip(self.files, self.dtypes):
+            f.seek(0)
+            f.write(npyHeader(dtype, self.nrows))
+            f.close()
+        schema = open(os.path.join(self.directory, schemaFile), 'w')
+        schema.write("column|dtype|file|rows\n")
+        for name, dtype in zip(self.header, self.dtypes):
+            # '|S50' would clash with the delimiter, 'S50' is the same type
+            schema.write("%s|%s|%s|%d\n" %(name, dtype.str.lstrip("|"), name + ".npy", self.nrows))
+        schema.close()
+        #}}}
+    #}}}
+
+def readSchema(directory): #{{{
+    """
+    The (column, dtype, file, rows) entries of a column store, in column order
+    """
+    f = open(os.path.join(directory, schemaFile))
+    f.readline()
+    schema = []
+    for line in f:
+        name, dtype, fname, nrows = line.rstrip("\n").split("|")
+        schema.append((name, np.dtype(dtype), fname, int(nrows)))
+    f.close()
+    return schema
+    #}}}
+
+def loadColumns(directory, columns = None, mmap_mode = 'r'): #{{{
+    """
+    Returns an OrderedDict from column name to a numpy array memory-mapped
+    from the column's file (read only by default). columns selects a subset.
+    """
+    store = OrderedDict()
+    for name, dtype, fname, nrows in readSchema(directory):
+        if columns is None or name in columns:
+            store[name] = np.load(os.path.join(directory, fname), mmap_mode = mmap_mode)
+    return store
+    #}}}
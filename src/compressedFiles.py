@@ -0,0 +1,132 @@
+# Opens the pipe delimited output files of simulator.py and dbToFile.py,
+# optionally gzip or zstd compressed, and reads them back whatever their
+# format.
+# Files are compressed as they are written - nothing is staged uncompressed.
+# gzip comes with python; zstd needs the zstandard package.
+
+import gzip
+import os
+
+compressionMethods = ["none", "gzip", "zstd"]
+
+suffixes = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+def compressedName(path, compress = None): #{{{
+    """
+    The name of path when it is written with the compression method compress
+    """
+    if compress is None:
+        compress = "none"
+    return path + suffixes[compress]
+    #}}}
+
+class ZstdWriter(object): #{{{
+    """
+    A write only file that zstd compresses everything written to it
+    """
+
+    def __init__(self, path):
+        import zstandard
+        self.raw = open(path, 'wb')
+        self.stream = zstandard.ZstdCompressor().stream_writer(self.raw)
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.stream.write(line)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+        if not self.raw.closed:
+            self.raw.close()
+    #}}}
+
+class ZstdReader(object): #{{{
+    """
+    Reads the lines of a zstd compressed file
+    """
+
+    def __init__(self, path, chunk = 1 << 20):
+        import zstandard
+        self.raw = open(path, 'rb')
+        self.chunks = zstandard.ZstdDecompressor().read_to_iter(self.raw, read_size = chunk)
+        self.buffer = ""
+
+    def readline(self):#{{{
+        while True:
+            end = self.buffer.find("\n")
+            if end >= 0:
+                line, self.buffer = self.buffer[:end+1], self.buffer[end+1:]
+                return line
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                line, self.buffer = self.buffer, ""
+                return line
+        #}}}
+
+    def __iter__(self):#{{{
+        while True:
+            lines = self.buffer.split("\n")
+            self.buffer = lines.pop()
+            for line in lines:
+                yield line + "\n"
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if self.buffer != "":
+            yield self.buffer
+            self.buffer = ""
+        #}}}
+
+    def close(self):
+        self.raw.close()
+    #}}}
+
+def openOutput(path, compress = None): #{{{
+    """
+    Opens path for writing with the compression method compress (one of
+    compressionMethods, None means "none"). The caller is responsible
+    for adding the suffix, see compressedName.
+    """
+    if compress is None or compress == "none":
+        return open(path, 'w')
+    elif compress == "gzip":
+        return gzip.open(path, 'wb', 6)
+    elif compress == "zstd":
+        return ZstdWriter(path)
+    else:
+        raise ValueError("Unknown compression method %s" %compress)
+    #}}}
+
+def openInput(path): #{{{
+    """
+    Opens path for reading lines, detecting gzip and zstd compressed files
+    from their first bytes
+    """
+    f = open(path, 'rb')
+    magic = f.read(4)
+    f.close()
+    if magic[:2] == "\x1f\x8b":
+        return gzip.open(path, 'rb')
+    elif magic == "\x28\xb5\x2f\xfd":
+        return ZstdReader(path)
+    else:
+        return open(path)
+    #}}}
+
+def findInput(path): #{{{
+    """
+    Finds the file path was written to, whichever compression method was used
+    """
+    for compress in compressionMethods:
+        if os.path.exists(compressedName(path, compress)):
+            return compressedName(path, compress)
+    raise IOError("No such file: %s" %path)
+    #}}}
@@ -3,14 +3,17 @@
 # example call: python dbToFile.py -r 2015_08_10_19_34_7597 -b 2_3 -d /tmp
 
 import os
-import MySQLdb
+import multiprocessing
+try:
+    import MySQLdb
+    import MySQLdb.cursors
+except ImportError:
+    # Only needed when not running against --sqlite
+    MySQLdb = None
+import sqliteDB
+from compressedFiles import compressionMethods, compressedName, openOutput
+from trainIndex import TrainIndexWriter
 from optparse import OptionParser
-import time
-import subprocess
-
-db = MySQLdb.connect(user = "root", passwd = 'TCADgBq7ShmpYfN3', db = 'assay_calib_sims', 
-        host = 'localhost')
-con = db.cursor()
 
 # Inputs
 createIndex = True
@@ -24,12 +27,64 @@ parser.add_option("-b", "--bio_prot",
 parser.add_option("-d", "--directory", dest="scriptDir",
         default = '/home/phillipl/projects/assay_calib_sims/data/',
         help="directory into which the data will be placed.")
+parser.add_option("--sqlite", dest="sqlite", default = None,
+        help="read the run from this SQLite database file (as written by simulator.py --sqlite) instead of the MySQL server")
+parser.add_option("--chunk-size", dest="chunk_size", default = 10000, type = "int",
+        help="how many rows to fetch from the server and write to the files at a time")
+parser.add_option("--star", dest="star", default = False, action = "store_true",
+        help="instead of the train and test files write the compact cohorts<b>_<p>.txt (prottab joined to cohorttab), subjects<b>_<p>.txt and visits<b>_<p>.txt files. starReader.py joins them back into train rows")
+parser.add_option("--columns", dest="columns", default = False, action = "store_true",
+        help="instead of the train and test files write the train rows as a memory-mappable binary column store, train<b>_<p>.columns/ with one .npy file per column (see columnStore.py)")
+parser.add_option("--compress", dest="compress", default = "none", type = "choice", choices = compressionMethods,
+        help="compress the files while they are written: none, gzip (.gz) or zstd (.zst, needs the zstandard package). Default: none")
+parser.add_option("--parts", dest="parts", default = 1, type = "int",
+        help="split the export on cohort_id ranges into this many train<b>_<p>.part-K.txt / test<b>_<p>.part-K.txt files, each written by its own process and connection, and list them in train<b>_<p>.manifest.txt")
+parser.add_option("--index", dest="index", default = False, action = "store_true",
+        help="write the rows ordered by cohort_id, sub_id and visit_id and write a train<b>_<p>.txt.idx (and test) index next to each file, with the byte offset and row count of every subject, so trainIndex.py can seek to any cohort or subject. Only for uncompressed train and test files")
 
 (options, args) = parser.parse_args()
+if options.index and (options.compress != "none" or options.star or options.columns):
+    parser.error("--index needs uncompressed train and test files")
+if options.columns and options.compress != "none":
+    parser.error("--compress does not apply to --columns, the column store is not compressed")
+if options.parts > 1 and (options.star or options.columns):
+    parser.error("--parts only splits the train and test files, not --star or --columns")
 
 print options
 #}}}
 
+def connectDB():
+    if options.sqlite is None:
+        return MySQLdb.connect(user = "root", passwd = 'TCADgBq7ShmpYfN3', db = 'assay_calib_sims', 
+                host = 'localhost')
+    else:
+        return sqliteDB.connect(options.sqlite)
+
+db = connectDB()
+con = db.cursor()
+
+def streamCursor(db):
+    """
+    A cursor that leaves the result set on the server and fetches it as
+    it is read (an SSCursor for MySQL), so the export runs in constant memory
+    """
+    if options.sqlite is None:
+        return db.cursor(MySQLdb.cursors.SSCursor)
+    else:
+        return db.cursor()
+
+def formatField(x):
+    """
+    Formats a value the way MySQL's INTO OUTFILE did: NULL as \\N and doubles
+    with 12 significant digits without a trailing .0
+    """
+    if x is None:
+        return "\\N"
+    elif isinstance(x, float):
+        return "%.12g" %x
+    else:
+        return str(x)
+
 runName     = options.run_id
 biol_prots  = [options.bio_prot]
 scriptDir   = options.scriptDir
@@ -38,6 +93,135 @@ scriptDir   = options.scriptDir
 tabs = ['prottab', 'cohorttab', 'subtab', 'visittab']
 id_cols = ['biol_id', 'prot_id', 'cohort_id', 'sub_id', 'visit_id']
 
+def exportRows(db, qstring, train_path, test_path, train_cols, test_cols, test_idx): #{{{
+    """
+    Streams the rows of the join in qstring into the train and test files.
+    The test file holds the visittab columns, which are the id columns and
+    the last columns of the join, so both files are written from one pass.
+    """
+    f = openOutput(compressedName(train_path, options.compress), options.compress)
+    train_header = "|".join(train_cols)+'\n'
+    f.writelines(train_header)
+    g = openOutput(compressedName(test_path, options.compress), options.compress)
+    test_header = "|".join(test_cols)+'\n'
+    g.writelines(test_header)
+    if options.index:
+        # the index needs the rows of every subject next to each other
+        qstring += "ORDER BY 3, 4, 5\n"
+        train_index = TrainIndexWriter(train_path, len(train_header))
+        test_index = TrainIndexWriter(test_path, len(test_header))
+
+    stream = streamCursor(db)
+    stream.execute(qstring)
+    dataSetSize = 0
+    while True:
+        data = stream.fetchmany(options.chunk_size)
+        if len(data) == 0:
+            break
+        train_lines = ["|".join([formatField(j) for j in i]) + '\n' for i in data]
+        test_lines = ["|".join([formatField(i[j]) for j in test_idx]) + '\n' for i in data]
+        f.writelines(train_lines)
+        g.writelines(test_lines)
+        if options.index:
+            for i, train_line, test_line in zip(data, train_lines, test_lines):
+                train_index.add(i[2], i[3], len(train_line))
+                test_index.add(i[2], i[3], len(test_line))
+        dataSetSize += len(data)
+    stream.close()
+    f.close()
+    g.close()
+    if options.index:
+        train_index.close()
+        test_index.close()
+    return dataSetSize
+    #}}}
+
+def exportTable(db, qstring, path, cols): #{{{
+    """
+    Streams the rows of qstring into a single file
+    """
+    f = openOutput(compressedName(path, options.compress), options.compress)
+    f.writelines("|".join(cols)+'\n')
+    stream = streamCursor(db)
+    stream.execute(qstring)
+    dataSetSize = 0
+    while True:
+        data = stream.fetchmany(options.chunk_size)
+        if len(data) == 0:
+            break
+        f.writelines(["|".join([formatField(j) for j in i]) + '\n' for i in data])
+        dataSetSize += len(data)
+    stream.close()
+    f.close()
+    return dataSetSize
+    #}}}
+
+def exportColumns(db, qstring, directory, train_cols): #{{{
+    """
+    Streams the rows of the join in qstring into a column store
+    """
+    import columnStore
+    store = columnStore.ColumnStoreWriter(directory, train_cols, columnStore.stringParameters(con))
+    stream = streamCursor(db)
+    stream.execute(qstring)
+    while True:
+        data = stream.fetchmany(options.chunk_size)
+        if len(data) == 0:
+            break
+        store.append_rows(data)
+    stream.close()
+    store.close()
+    return store.nrows
+    #}}}
+
+def exportStar(run_dir, fp, tab_cols, tab_shrt_cols): #{{{
+    """
+    Writes the star schema of a run: every cohort, subject and visit once,
+    keyed by the id columns, instead of repeating the protocol, cohort and
+    subject columns on every visit like the train file does
+    """
+    prot_tab, cohort_tab, sub_tab, visit_tab = ["run_%s_%s_%s" %(runName, tab, fp) for tab in tabs]
+    qstring = """SELECT %s.biol_id, %s.prot_id, %s.cohort_id, %s
+    FROM %s, %s
+    WHERE %s.biol_id = %s.biol_id
+    AND %s.prot_id = %s.prot_id""" %(cohort_tab, cohort_tab, cohort_tab,
+            ", ".join(tab_cols[tabs[0]] + tab_cols[tabs[1]]),
+            prot_tab, cohort_tab,
+            prot_tab, cohort_tab,
+            prot_tab, cohort_tab)
+    exportTable(db, qstring, os.path.join(run_dir, 'cohorts%s.txt' %fp),
+            id_cols[:3] + tab_shrt_cols[tabs[0]] + tab_shrt_cols[tabs[1]])
+    qstring = "SELECT biol_id, prot_id, cohort_id, sub_id, %s FROM %s" %(", ".join(tab_shrt_cols[tabs[2]]), sub_tab)
+    exportTable(db, qstring, os.path.join(run_dir, 'subjects%s.txt' %fp),
+            id_cols[:4] + tab_shrt_cols[tabs[2]])
+    qstring = "SELECT biol_id, prot_id, cohort_id, sub_id, visit_id, %s FROM %s" %(", ".join(tab_shrt_cols[tabs[3]]), visit_tab)
+    return exportTable(db, qstring, os.path.join(run_dir, 'visits%s.txt' %fp),
+            id_cols + tab_shrt_cols[tabs[3]])
+    #}}}
+
+def exportPart(part): #{{{
+    """
+    Exports the visits of one cohort_id range over its own connection.
+    Runs in the worker processes of a --parts export.
+    """
+    qstring, visit_tab, first, last, train_path, test_path, train_cols, test_cols, test_idx = part
+    qstring += "AND %s.cohort_id BETWEEN %d AND %d\n" %(visit_tab, first, last)
+    part_db = connectDB()
+    dataSetSize = exportRows(part_db, qstring, train_path, test_path, train_cols, test_cols, test_idx)
+    part_db.close()
+    return dataSetSize
+    #}}}
+
+def cohortRanges(cohort_ids, nparts): #{{{
+    """
+    Splits the sorted cohort_ids into at most nparts contiguous
+    (first, last) ranges with about the same number of cohorts each
+    """
+    nparts = min(nparts, len(cohort_ids))
+    bounds = [k * len(cohort_ids) // nparts for k in range(nparts + 1)]
+    return [(cohort_ids[bounds[k]], cohort_ids[bounds[k+1] - 1]) for k in range(nparts)]
+    #}}}
+
 try:
     if createIndex:
         for fp in biol_prots:
@@ -53,6 +237,8 @@ for fp in biol_prots:
     print fp
     cols = []
     shrt_cols = []
+    tab_cols = {}
+    tab_shrt_cols = {}
     for tab in tabs:
         full_tab_name = "run_%s_%s_%s" %(runName, tab, fp, )
         con.execute("describe %s"%full_tab_name )
@@ -64,6 +250,8 @@ for fp in biol_prots:
                 the_shrt_cols.append(stuff)
         cols += the_cols
         shrt_cols += the_shrt_cols
+        tab_cols[tab] = the_cols
+        tab_shrt_cols[tab] = the_shrt_cols
 
     qstring='''
     SELECT run_%s_%s_%s.biol_id, 
@@ -119,60 +307,44 @@ for fp in biol_prots:
         runName, tabs[3], fp # join 3 - 4 - 2
         )
     print qstring
-    cqstring = "CREATE TABLE IF NOT EXISTS run_%s_train_%s " %(runName, fp, ) + qstring
-    con.execute(cqstring)
-    db.commit()
     print id_cols+shrt_cols
     if not os.path.isdir(os.path.join(scriptDir, '%s' %runName )):
         print(os.path.join(scriptDir, '%s' %runName ))
         os.mkdir(os.path.join(scriptDir, '%s' %runName ))#'data/%s' %runName)
 
-    indx_string = "ALTER TABLE run_%s_train_%s ADD INDEX `indx1` (`cohort_id` ASC, `sub_id` ASC, `visit_id` ASC)" %(runName, fp, )
-    try:
-        con.execute(indx_string)
-        db.commit()
-    except:
-        print "index already existed"
-
-    f = open(os.path.join(scriptDir, '%s/train%s.txt' %(runName, fp,)) ,'w')
-    f.writelines("|".join([str(i) for i in id_cols+shrt_cols])+'\n')
-    g = open(os.path.join(scriptDir, '%s/test%s.txt' %(runName, fp,)) ,'w')
-    g.writelines("|".join(["biol_id", "prot_id", "cohort_id", "sub_id", "visit_id", "visit_date", "bmv"])+'\n')
-    g.close()
+    train_cols = id_cols + shrt_cols
+    test_cols = id_cols + the_shrt_cols
+    test_idx = range(len(id_cols)) + range(len(train_cols) - len(the_shrt_cols), len(train_cols))
+    run_dir = os.path.join(scriptDir, runName)
 
-    # If the dataset is smallish, write to file
-    con.execute("select count(*) from run_%s_train_%s " %(runName, fp, ))
-    dataSetSize = con.fetchall()[0][0]
-    print dataSetSize
-    if dataSetSize < 10:
-        con.execute(qstring)
-        data=con.fetchall() # gonna run outta ram here <<<<---- :p
-        for i in data[:5]:
-            print i
-        for i in data:
-            f.writelines("|".join([str(j) for j in i])+'\n')
-        f.close()
+    if options.star:
+        dataSetSize = exportStar(run_dir, fp, tab_cols, tab_shrt_cols)
+    elif options.columns:
+        dataSetSize = exportColumns(db, qstring, os.path.join(run_dir, 'train%s.columns' %fp), train_cols)
+    elif options.parts <= 1:
+        dataSetSize = exportRows(db, qstring,
+                os.path.join(run_dir, 'train%s.txt' %fp), os.path.join(run_dir, 'test%s.txt' %fp),
+                train_cols, test_cols, test_idx)
     else:
-        f.close()
-        print "file too large - dont pull the data into ram in python instead push it directly from mysql into a file"
-        print "train data set"
-        dump_string = "SELECT * from run_%s_train_%s into outfile '/tmp/train%s%s.txt.noheader' fields terminated by '|'" %(runName, fp, runName, fp)
-        print dump_string
-        con.execute(dump_string)
-        print "sleeping - wait a little to prevent the next step from starting before the file write is completed"
-        time.sleep(10)
-        command = "cat /tmp/train%s%s.txt.noheader >> %s/%s/train%s.txt"%(runName, fp, scriptDir, runName, fp)
-        print command
-        subprocess.call(command, shell = True)
-
-        print "test data set"
-        dump_string = "SELECT * from run_%s_visittab_%s into outfile '/tmp/test%s%s.txt.noheader' fields terminated by '|'" %(runName, fp, runName, fp)
-        print dump_string
-        con.execute(dump_string)
-        print "sleeping - wait a little to prevent the next step from starting before the file write is completed"
-        time.sleep(10)
-        command = "cat /tmp/test%s%s.txt.noheader >> %s/%s/test%s.txt"%(runName, fp, scriptDir, runName, fp)
-        print command
-        subprocess.call(command, shell = True)
-
-    db.close()
+        cohort_tab = "run_%s_%s_%s" %(runName, tabs[1], fp)
+        visit_tab = "run_%s_%s_%s" %(runName, tabs[3], fp)
+        con.execute("SELECT DISTINCT cohort_id FROM %s ORDER BY cohort_id" %cohort_tab)
+        ranges = cohortRanges([r[0] for r in con.fetchall()], options.parts)
+        parts = [(qstring, visit_tab, first, last,
+            os.path.join(run_dir, 'train%s.part-%d.txt' %(fp, k)), os.path.join(run_dir, 'test%s.part-%d.txt' %(fp, k)),
+            train_cols, test_cols, test_idx) for k, (first, last) in enumerate(ranges)]
+        pool = multiprocessing.Pool(options.parts)
+        counts = pool.map(exportPart, parts)
+        pool.close()
+        pool.join()
+        m = open(os.path.join(run_dir, 'train%s.manifest.txt' %fp), 'w')
+        m.write("part|first_cohort_id|last_cohort_id|rows|train_file|test_file\n")
+        for k in range(len(parts)):
+            m.write("%d|%d|%d|%d|%s|%s\n" %(k, parts[k][2], parts[k][3], counts[k],
+                os.path.basename(compressedName(parts[k][4], options.compress)),
+                os.path.basename(compressedName(parts[k][5], options.compress))))
+        m.close()
+        dataSetSize = sum(counts)
+    print dataSetSize, "rows written"
+
+db.close()
@@ -3,11 +3,12 @@
 # and then prints the insert statement for the new parameter sets
 # Example call: python par_set_cloner.py --biol-prot=biol --id=0 --version=v0.4 --ps=1 --target-ps=new_parameter_set_name
 
-import optparse, MySQLdb
-
-db = MySQLdb.connect(user = "root", passwd = 'TCADgBq7ShmpYfN3', db = 'assay_calib_sims', 
-        host = 'localhost')
-con = db.cursor()
+import optparse, sqliteDB
+try:
+    import MySQLdb
+except ImportError:
+    # Only needed when not running against --sqlite
+    MySQLdb = None
 
 usage = """%prog [options]
 It is often required to make a copy of a parameter set with only one or two very small changes.
@@ -23,9 +24,17 @@ parser.add_option("--id", action="store", dest="id", default=None, help="Id of b
 parser.add_option("--version", action="store", dest="version", default=None, help="Version of biology or protocol to clone")
 parser.add_option("--ps", action="store", dest="ps", default=None, help="Name of the parameter set to clone")
 parser.add_option("--target-ps", action="store", dest="target_ps", default=None, help="Name of the new parameter set to be created")
+parser.add_option("--sqlite", action="store", dest="sqlite", default=None, help="Read the parameter set from this SQLite database file instead of the MySQL server; a new file is seeded from acs_no_sims_20150810.sql")
 
 (options, args) = parser.parse_args()
 
+if options.sqlite is None:
+    db = MySQLdb.connect(user = "root", passwd = 'TCADgBq7ShmpYfN3', db = 'assay_calib_sims', 
+            host = 'localhost')
+else:
+    db = sqliteDB.connect(options.sqlite)
+con = db.cursor()
+
 table_name = "biology_parameter_sets" if options.biol_prot == "biol" else "protocol_parameter_sets"
 table_id = "biol_id" if options.biol_prot == "biol" else "prot_id"
 table_ver = "biol_ver" if options.biol_prot == "biol" else "prot_ver"
@@ -29,13 +29,14 @@
 # If you use an editor like vim you can set foldmethod=marker and then the
 # structure of the code will be clearer. The basic outline is:
 # imports: load python modules
-# Database Connection 
 # Commanline Argument Parsing
+# Database Connection: MySQL or, with --sqlite, an embedded SQLite file
 # Class Declarations - much of this is focussed on the webui.
 # Initialise database tables
 # Specify the Function Forms (Biologies)
 # Specify Protocols 
 # Functions to save data in the database 
+# The cohort engines: simulate the subjects and visits of a single cohort
 # The big function that simulates the data: simulateCohorts
 # A function related to the computation of exact solutions: exactSolutions
 # Prepare the biologies and protocols from the commandline arguments
@@ -47,11 +48,24 @@
 import datetime
 import random
 import math
+import itertools
+import os
+import tempfile
+import hashlib
+import multiprocessing
 #import utilities as util
 #import simulator_cfg as cfg
 from UserDict import UserDict
-import MySQLdb
-import scipy.stats
+try:
+    import MySQLdb
+except ImportError:
+    # Only needed when not running against --sqlite
+    MySQLdb = None
+import sqliteDB
+from compressedFiles import compressionMethods, compressedName, openOutput
+import columnStore
+from trainIndex import TrainIndexWriter
+# scipy is only needed for the exact solutions and is imported there
 from optparse import OptionParser
 import numpy
 #from cspy.utility.html import TextSetting
@@ -60,10 +74,6 @@ import time
 #import logging
 #logging.basicConfig(level=logging.debug, filename = 'simulator.log') #}}}
 
-# Database Connection {{{
-db = MySQLdb.connect(user = "root", passwd = 'TCADgBq7ShmpYfN3', db = 'assay_calib_sims', host = 'localhost')
-con = db.cursor() #}}}
-
 # Commanline Argument Parsing {{{
 parser = OptionParser()
 parser.add_option("-c", "--command", dest="command", help="What action to perform: 'sims' for simulating a cohort's biomarker value or 'exact' for computing an exact solution.")
@@ -72,12 +82,52 @@ parser.add_option("-b", "--biologies", dest="reqBiologies", help="What biologies
 parser.add_option("-n", "--ncohorts", dest="ncohorts_input", help="How many cohorts to simulate for each scenario")
 parser.add_option("--do-not-round", dest="roundVisitDates", default = True, action = "store_false", help="Should the visit dates be rounded?")
 parser.add_option("--do-not-restrict-bmv", dest="restrictBMV", default = True, action = "store_false", help="Should the BMVs be resticted to be greater than zero?")
+parser.add_option("--engine", dest="engine", default = "scalar", type = "choice", choices = ["scalar", "numpy"], help="How to simulate each cohort: 'scalar' draws one subject and one visit at a time, 'numpy' draws all the subjects and visits of a cohort at once as numpy arrays. Default: scalar")
+parser.add_option("--batch-size", dest="batch_size", default = 1000, action = "store", type = "int", help="How many rows to send to the database per INSERT. The rows of a cohort are committed once the whole cohort has been written. Default: 1000")
+parser.add_option("--sink", dest="sink", default = "insert", type = "choice", choices = ["insert", "loaddata", "files", "train", "columns"], help="Where and how to write the simulated data: 'insert' sends batched INSERTs to MySQL, 'loaddata' writes each table to a temporary file and loads it into MySQL with LOAD DATA LOCAL INFILE once the run is finished, 'files' writes each table to a pipe delimited file in --out-dir and does not touch the MySQL run tables at all, 'train' writes the joined train<b>_<p>.txt and test<b>_<p>.txt files of dbToFile.py into --out-dir/<run name>/ without storing the run tables, 'columns' writes the same train rows as a memory-mappable binary column store (one .npy file per column, see columnStore.py) into --out-dir/<run name>/train<b>_<p>.columns/. Default: insert")
+parser.add_option("--compress", dest="compress", default = "none", type = "choice", choices = compressionMethods, help="Compress the files of the 'files' and 'train' sinks while they are written: none, gzip (.gz) or zstd (.zst, needs the zstandard package). Default: none")
+parser.add_option("--out-dir", dest="out_dir", default = None, action = "store", help="Directory for the 'files', 'train' and 'columns' sinks (default: the current directory) and for the temporary files of the 'loaddata' sink (default: the system temporary directory).")
+parser.add_option("--workers", dest="workers", default = 1, action = "store", type = "int", help="How many processes to simulate the cohorts with. Every cohort gets its own random number stream, so the results do not depend on the number of workers. Default: 1")
+parser.add_option("--seed", dest="seed", default = None, action = "store", type = "int", help="Master seed of the random number streams. A run with the same seed, biologies, protocols and engine reproduces the same data. If not given a random seed is used and printed.")
+parser.add_option("--cohorts", dest="cohorts", default = None, action = "store", help="Only simulate these cohort_ids, e.g. '17' or '0-9,20'. Together with --seed this regenerates single cohorts (or a failed shard) without simulating the rest of the run.")
+parser.add_option("--subjects", dest="subjects", default = None, action = "store", help="Only keep these sub_ids of each cohort, e.g. '3' or '0-4'. With the scalar engine only those subjects are simulated.")
 parser.add_option("--threshold", dest="threshold", default = 0, action = "store", type = "float", help="The threshold for the exact solution. WARNING: computation of exact methods are buggy - rather use R")
 parser.add_option("--bigT", dest="bigT", default = 365, action = "store", type = "float", help="The bigT for the exact solution. WARNING: computation of exact methods are buggy - rather use R")
 parser.add_option("--integration-method", dest="integration_method", default = "quad", action = "store", type = "string", help="Which integration method should be used for the computation of the exact method? quad / monte carlo. WARNING: computation of exact methods are buggy - rather use R")
+parser.add_option("--sqlite", dest="sqlite", default = None, action = "store", help="Use this SQLite database file instead of the MySQL server. If the file does not exist it is created and seeded from --sqlite-dump. The parameter sets are read from it and the run tables are stored in it.")
+parser.add_option("--sqlite-dump", dest="sqlite_dump", default = sqliteDB.defaultDump, action = "store", help="MySQL dump used to seed a new --sqlite database. Default: acs_no_sims_20150810.sql next to this script")
 (options, args) = parser.parse_args()
+if options.compress != "none" and options.sink not in ("files", "train"):
+    parser.error("--compress only applies to the 'files' and 'train' sinks")
 #}}}
 
+# Database Connection {{{
+def connectDB():
+    if options.sqlite is None:
+        return MySQLdb.connect(user = "root", passwd = 'TCADgBq7ShmpYfN3', db = 'assay_calib_sims', host = 'localhost', local_infile = 1)
+    else:
+        return sqliteDB.connect(options.sqlite, options.sqlite_dump)
+
+class LazyObject(object): #{{{
+    """
+    Stands in for the object made by factory, which is only called the
+    first time one of the object's attributes is used. db and con are
+    LazyObjects so that -h and commands that never touch the database do
+    not have to connect to it.
+    """
+    def __init__(self, factory):
+        self.__dict__['factory'] = factory
+        self.__dict__['obj'] = None
+
+    def __getattr__(self, name):
+        if self.__dict__['obj'] is None:
+            self.__dict__['obj'] = self.__dict__['factory']()
+        return getattr(self.__dict__['obj'], name)
+    #}}}
+
+db = LazyObject(connectDB)
+con = LazyObject(lambda: db.cursor()) #}}}
+
 # Class Declarations {{{
 
 class ReportOption(object): #{{{@never_cache
@@ -276,9 +326,16 @@ class Biology(odict):#{{{
         self.version = version
         self.table = table
         self.parameters = parameters
-        self.refresh_par_sets()
     #}}}
 
+    def __getattr__(self, name): #{{{
+        # The parameter sets are only loaded from the database when they are first used
+        if name in ("par_set_ids", "par_sets"):
+            self.refresh_par_sets()
+            return self.__dict__[name]
+        raise AttributeError(name)
+        #}}}
+
     def refresh_par_sets(self): #{{{
         #print "refreshing parsets"
         self.par_set_ids = self.table.get_par_set_ids(self.id, self.version)
@@ -313,7 +370,14 @@ class Protocol(odict):#{{{
         self.version = version
         self.table = table
         self.parameters = parameters
-        self.refresh_par_sets()
+        #}}}
+
+    def __getattr__(self, name): #{{{
+        # The parameter sets are only loaded from the database when they are first used
+        if name in ("par_set_ids", "par_sets"):
+            self.refresh_par_sets()
+            return self.__dict__[name]
+        raise AttributeError(name)
         #}}}
 
     def refresh_par_sets(self): #{{{
@@ -341,11 +405,68 @@ class Protocol(odict):#{{{
 
 # Initialise database tables {{{
 
+def groupParSets(data):#{{{
+    """
+    Splits the rows of a bulk parameter set query, sorted by id, version
+    and ps, into ((id, version, ps), [(variable, type, value, position)])
+    """
+    for key, rows in itertools.groupby(data, lambda r: tuple(r[:3])):
+        yield key, [tuple(r[3:]) for r in rows]
+    #}}}
+
+def latestParSetIds(cache, type_id = None, type_ver = None):#{{{
+    """
+    The in memory version of the get_par_set_ids query: the ps of the sets
+    whose version is the latest version of their id, optionally only those
+    of type_id and type_ver
+    """
+    keys = [k for k in cache.keys() if len(cache[k][0]['parameters']) > 0]
+    latest = {}
+    for k in keys:
+        if k[0] not in latest or k[1] > latest[k[0]]:
+            latest[k[0]] = k[1]
+    ids = set()
+    for k in keys:
+        if k[1] != latest[k[0]]:
+            continue
+        if type_id is not None and (k[0] != str(type_id) or k[1] != str(type_ver)):
+            continue
+        ids.add(k[2])
+    return sorted(ids, key = lambda ps: ps.lower())
+    #}}}
+
+def copyParSet(x):#{{{
+    """
+    Copies a cached [par_set, combo] pair from load_set so that callers
+    can not change the cached parameter set
+    """
+    par_set, combo = x
+    par_set = dict(par_set)
+    par_set['parameters'] = [dict(par) for par in par_set['parameters']]
+    return [par_set, combo.copy()]
+    #}}}
+
+def invalidateParSets(cache, type_id, type_ver, ps):#{{{
+    """
+    Returns the cache without the entries matching (type_id, type_ver, ps),
+    where None matches anything
+    """
+    key = (type_id, type_ver, ps)
+    keep = {}
+    for k in cache.keys():
+        matches = [key[i] is None or str(key[i]) == k[i] for i in range(3)]
+        if not all(matches):
+            keep[k] = cache[k]
+    return keep
+    #}}}
+
 class BiologyParameterSetTable(object):#{{{
 
     def __init__(self):
         self.tableName = 'biology_parameter_sets'
-        pass
+        # parsed parameter sets: (biol_id, biol_ver, ps) -> [par_set, combo]
+        self.cache = {}
+        self.preloaded = False
 
     def create_table(self):#{{{
         con.execute("DROP TABLE IF EXISTS `%s`" %(self.tableName))
@@ -359,6 +480,7 @@ class BiologyParameterSetTable(object):#{{{
           `position` INTEGER DEFAULT NULL
           ) ENGINE=InnoDB''' %(self.tableName) )
         db.commit()
+        self.invalidate()
         return True
         #}}}
 
@@ -378,11 +500,19 @@ class BiologyParameterSetTable(object):#{{{
             con.execute(query)
             position += 1
         db.commit()
+        self.invalidate(new_set["biol_id"], new_set["biol_ver"], new_set["ps"])
         return True
         #}}}
 
     def get_par_set_ids(self, biol_id = 'False == 0 is True - darn', biol_ver = 'False == 0 is True - darn'):#{{{
         # The default values assigned might hint at a bug that was tricky to catch
+        if not self.preloaded:
+            self.preload()
+        if self.preloaded:
+            if biol_id != 'False == 0 is True - darn' and biol_ver != 'False == 0 is True - darn':
+                return latestParSetIds(self.cache, biol_id, biol_ver)
+            else:
+                return latestParSetIds(self.cache)
         query = '''SELECT distinct(ps) FROM %s a
             INNER JOIN (select biol_id pid, max(biol_ver) pvr 
             from %s 
@@ -399,6 +529,42 @@ class BiologyParameterSetTable(object):#{{{
     #}}}
 
     def load_set(self, biol_id, biol_ver, ps):#{{{
+        """
+        The parsed parameter set is cached, so the database is only queried
+        the first time a set is loaded. Callers get their own copy.
+        """
+        key = (str(biol_id), str(biol_ver), str(ps))
+        if key not in self.cache and not self.preloaded:
+            self.preload()
+        if key not in self.cache:
+            self.cache[key] = self.query_set(biol_id, biol_ver, ps)
+        return copyParSet(self.cache[key])
+        #}}}
+
+    def invalidate(self, biol_id = None, biol_ver = None, ps = None):#{{{
+        """
+        Drops cached parameter sets. Arguments that are None match anything,
+        so invalidate() clears the whole cache.
+        """
+        self.cache = invalidateParSets(self.cache, biol_id, biol_ver, ps)
+        self.preloaded = False
+        #}}}
+
+    def preload(self):#{{{
+        """
+        Loads and parses every parameter set in the table with a single
+        query, instead of one query per set
+        """
+        query = '''SELECT biol_id, biol_ver, ps, variable, type, value, position from %s
+        ORDER BY biol_id, biol_ver, ps, position''' %(self.tableName)
+        con.execute(query)
+        self.cache = {}
+        for key, data in groupParSets(con.fetchall()):
+            self.cache[(str(key[0]), str(key[1]), str(key[2]))] = self.parse_set(key[0], key[1], key[2], data)
+        self.preloaded = True
+        #}}}
+
+    def query_set(self, biol_id, biol_ver, ps):#{{{
         query = '''SELECT variable, type, value, position from %s
         WHERE biol_id = "%s"
         AND biol_ver = "%s"
@@ -406,6 +572,13 @@ class BiologyParameterSetTable(object):#{{{
         ORDER BY position''' %(self.tableName, biol_id, biol_ver, ps)
         con.execute(query)
         data = con.fetchall()
+        return self.parse_set(biol_id, biol_ver, ps, data)
+        #}}}
+
+    def parse_set(self, biol_id, biol_ver, ps, data):#{{{
+        """
+        data are the (variable, type, value, position) rows of the set
+        """
         par_set = {"biol_id": biol_id,
             "biol_ver": biol_ver,
             "ps": ps,
@@ -478,7 +651,9 @@ class ProtocolParameterSetTable(object):#{{{
 
     def __init__(self):
         self.tableName = 'protocol_parameter_sets'
-        pass
+        # parsed parameter sets: (prot_id, prot_ver, ps) -> [par_set, combo]
+        self.cache = {}
+        self.preloaded = False
 
     def create_table(self):#{{{
         con.execute("DROP TABLE IF EXISTS `%s`" %(self.tableName))
@@ -492,6 +667,7 @@ class ProtocolParameterSetTable(object):#{{{
           `position` INTEGER DEFAULT NULL
           ) ENGINE=InnoDB''' %(self.tableName) )
         db.commit()
+        self.invalidate()
         return True
         #}}}
 
@@ -515,10 +691,18 @@ class ProtocolParameterSetTable(object):#{{{
             con.execute(query)
             position += 1
         db.commit()
+        self.invalidate(new_set["prot_id"], new_set["prot_ver"], new_set["ps"])
         return True
         #}}}
 
     def get_par_set_ids(self, prot_id='False == 0 is True - darn', prot_ver='False == 0 is True - darn'):#{{{
+        if not self.preloaded:
+            self.preload()
+        if self.preloaded:
+            if prot_id != 'False == 0 is True - darn' and prot_ver != 'False == 0 is True - darn':
+                return latestParSetIds(self.cache, prot_id, prot_ver)
+            else:
+                return latestParSetIds(self.cache)
         query = '''SELECT distinct(ps) FROM %s a 
             INNER JOIN (select prot_id pid, max(prot_ver) pvr 
             from %s 
@@ -535,6 +719,42 @@ class ProtocolParameterSetTable(object):#{{{
     #}}}
 
     def load_set(self, prot_id, prot_ver, ps):#{{{
+        """
+        The parsed parameter set is cached, so the database is only queried
+        the first time a set is loaded. Callers get their own copy.
+        """
+        key = (str(prot_id), str(prot_ver), str(ps))
+        if key not in self.cache and not self.preloaded:
+            self.preload()
+        if key not in self.cache:
+            self.cache[key] = self.query_set(prot_id, prot_ver, ps)
+        return copyParSet(self.cache[key])
+        #}}}
+
+    def invalidate(self, prot_id = None, prot_ver = None, ps = None):#{{{
+        """
+        Drops cached parameter sets. Arguments that are None match anything,
+        so invalidate() clears the whole cache.
+        """
+        self.cache = invalidateParSets(self.cache, prot_id, prot_ver, ps)
+        self.preloaded = False
+        #}}}
+
+    def preload(self):#{{{
+        """
+        Loads and parses every parameter set in the table with a single
+        query, instead of one query per set
+        """
+        query = '''SELECT prot_id, prot_ver, ps, variable, type, value, position from %s
+        ORDER BY prot_id, prot_ver, ps, position''' %(self.tableName)
+        con.execute(query)
+        self.cache = {}
+        for key, data in groupParSets(con.fetchall()):
+            self.cache[(str(key[0]), str(key[1]), str(key[2]))] = self.parse_set(key[0], key[1], key[2], data)
+        self.preloaded = True
+        #}}}
+
+    def query_set(self, prot_id, prot_ver, ps):#{{{
         query = '''SELECT variable, type, value, position from %s
         WHERE prot_id = "%s"
         AND prot_ver = "%s"
@@ -542,6 +762,13 @@ class ProtocolParameterSetTable(object):#{{{
         ORDER BY position''' %(self.tableName, prot_id, prot_ver, ps)
         con.execute(query)
         data = con.fetchall()
+        return self.parse_set(prot_id, prot_ver, ps, data)
+        #}}}
+
+    def parse_set(self, prot_id, prot_ver, ps, data):#{{{
+        """
+        data are the (variable, type, value, position) rows of the set
+        """
         par_set = {"prot_id": prot_id,
             "prot_ver": prot_ver,
             "ps": ps,
@@ -671,6 +898,73 @@ def extractPSpro(prot):#{{{
 
 # }}}
 
+# Shared random number generators {{{
+
+def truncNormal(mu, sd, lower, size = None): #{{{
+    """
+    Draws from the normal distribution with mean mu and standard deviation
+    sd truncated below at lower (values >= lower are kept).
+    If lower is below the mean, normal draws under lower are drawn again,
+    which keeps at least half of them. Otherwise the draws come from the
+    exponential proposal of Robert (1995), which keeps more than 3/4 of
+    them however far into the tail lower is. Either way the expected cost of
+    a draw does not depend on the truncation.
+    Returns a float, or an array of size draws.
+    """
+    n = 1 if size is None else size
+    if sd <= 0:
+        x = np.repeat(float(mu), n)
+    else:
+        a = (lower - mu) / float(sd)
+        lam = (a + math.sqrt(a*a + 4)) / 2
+        x = np.empty(n)
+        todo = np.arange(n)
+        while len(todo) > 0:
+            if a <= 0:
+                z = np.random.standard_normal(len(todo))
+                keep = z >= a
+            else:
+                z = a + np.random.exponential(1 / lam, len(todo))
+                keep = np.random.uniform(size = len(todo)) <= np.exp(-(z - lam)**2 / 2)
+            x[todo[keep]] = z[keep]
+            todo = todo[~keep]
+        x = mu + sd * x
+    if size is None:
+        return float(x[0])
+    return x
+    #}}}
+
+mvnFactors = {}
+
+def mvnFactor(cov): #{{{
+    """
+    The matrix A with cov = A'A that numpy.random.multivariate_normal
+    computes from the singular value decomposition of cov (which, unlike
+    a Cholesky factor, also exists when a parameter set has a standard
+    deviation of 0). It is computed once per covariance matrix, i.e. once
+    per parameter set, instead of once per draw.
+    """
+    key = tuple([tuple(row) for row in cov])
+    if key not in mvnFactors:
+        (u, s, v) = np.linalg.svd(np.array(cov, dtype = float))
+        mvnFactors[key] = np.sqrt(s)[:, None] * v
+    return mvnFactors[key]
+    #}}}
+
+def mvnDraws(mean, cov, size): #{{{
+    """
+    size draws (rows) from the multivariate normal distribution - the values
+    numpy.random.multivariate_normal(mean, cov, size) gives for the same
+    state of numpy.random
+    """
+    x = np.random.standard_normal((size, len(mean)))
+    x = np.dot(x, mvnFactor(cov))
+    x += mean
+    return x
+    #}}}
+
+#}}}
+
 # Specify the Function Forms (Biologies){{{
 
 # Description {{{
@@ -700,7 +994,18 @@ def extractPSpro(prot):#{{{
 #       i.e. it generates the subject specific parameters
 
 # A function form family must be combined with a protocol inorder for a simulation
-#   to be completely specified }}}
+#   to be completely specified
+
+# For the numpy engine (--engine=numpy) a function form can also supply
+#   vectorised versions of the subject and visit level functions:
+#   ffx_sub_pars_gen_vec
+#       Same as ffx_sub_pars_gen, but simulates the parameters of all the
+#       subjects of a cohort at once. It returns an odict of numpy arrays.
+#   ffx_bmf_fun_vec
+#       Same as ffx_bmf_fun, but is given arrays of subject parameters and an
+#       array of visit dates and returns an array of biomarker values.
+#   If they are missing the numpy engine falls back to calling the scalar
+#   functions once per subject / visit. }}}
 
 # Specify ff1 {{{ root
 def ff1_bmf_fun(ff_cohort_pars, 
@@ -758,6 +1063,44 @@ def ff1_sub_pars_gen(prot_prot_pars,
 
     return results #}}}
 
+def ff1_bmf_fun_vec(ff_cohort_pars,
+        ff_sub_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        t): #{{{
+
+    alpha = ff_sub_pars['alpha']
+    theta = ff_sub_pars['theta']
+    seroconversion_date = prot_sub_pars['seroconversion_date']
+    sigma = ff_cohort_pars['sigma']
+
+    error_term = sigma * np.random.standard_normal(len(t))
+    Z = 8 * np.power(np.maximum(0, (t - seroconversion_date - alpha)), theta)
+
+    if options.restrictBMV:
+        return np.maximum(0, Z + error_term)
+    else:
+        return Z + error_term
+    #}}}
+
+def ff1_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+
+    theta_l = ff_cohort_pars['theta_l']
+    theta_u = ff_cohort_pars['theta_u']
+    alpha_l = ff_cohort_pars['alpha_l']
+    alpha_u = ff_cohort_pars['alpha_u']
+
+    results = odict()
+    results['alpha'] = np.random.uniform(alpha_l, alpha_u, nsubs)
+    results['theta'] = np.random.uniform(theta_l, theta_u, nsubs)
+
+    return results #}}}
+
 biology1 = Biology(id=0, version="v0.6", table=bioObj, parameters = [#{{{
         AnnotatedTextSetting(name="biol0_par_theta_l", title="Theta: Lower Bound", default = 0.275, db_var_name = "theta_l"),
         AnnotatedTextSetting(name="biol0_par_theta_u", title="Theta: Upper Bound", default = 0.325, db_var_name = "theta_u"),
@@ -768,6 +1111,8 @@ biology1 = Biology(id=0, version="v0.6", table=bioObj, parameters = [#{{{
 biology1['bmf_fun'] = ff1_bmf_fun
 biology1['cohort_pars_gen'] = ff1_cohort_pars_gen
 biology1['sub_pars_gen'] = ff1_sub_pars_gen
+biology1['bmf_fun_vec'] = ff1_bmf_fun_vec
+biology1['sub_pars_gen_vec'] = ff1_sub_pars_gen_vec
 biology1['version'] = 'v0.6'
 biology1['biol_id'] = 0 #}}}
 
@@ -844,6 +1189,44 @@ def ff2_sub_pars_gen(prot_prot_pars,
 
     return results #}}}
 
+def ff2_bmf_fun_vec(ff_cohort_pars,
+        ff_sub_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        t): #{{{
+
+    seroconversion_date = prot_sub_pars['seroconversion_date']
+    alpha = ff_sub_pars['alpha']
+    theta = ff_sub_pars['theta']
+    sigma = ff_cohort_pars['sigma']
+
+    error_term = sigma * np.random.standard_normal(len(t))
+    Z = np.maximum(0, np.log(np.maximum(t - seroconversion_date - alpha, 1)) / np.log(theta))
+
+    if options.restrictBMV:
+        return np.maximum(0, Z + error_term)
+    else:
+        return Z + error_term
+    #}}}
+
+def ff2_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+
+    theta_l = ff_cohort_pars['theta_l']
+    theta_u = ff_cohort_pars['theta_u']
+    alpha_l = ff_cohort_pars['alpha_l']
+    alpha_u = ff_cohort_pars['alpha_u']
+
+    results = odict()
+    results['alpha'] = np.random.uniform(alpha_l, alpha_u, nsubs)
+    results['theta'] = np.random.uniform(theta_l, theta_u, nsubs)
+
+    return results #}}}
+
 def ff2_exact(ff_cohort_pars, bigT = 600): #{{{
     """
     This function computes the exact solution for
@@ -852,6 +1235,7 @@ def ff2_exact(ff_cohort_pars, bigT = 600): #{{{
         parameters for distributions of each parameter
         The distributions themselves are hard-coded
     """
+    import scipy.stats, scipy.integrate
     theta_l = ff_cohort_pars['theta_l']
     theta_u = ff_cohort_pars['theta_u']
     alpha_l = ff_cohort_pars['alpha_l']
@@ -916,6 +1300,8 @@ biology2['bmf_fun'] = ff2_bmf_fun
 biology2['cohort_pars_gen'] = ff2_cohort_pars_gen
 biology2['sub_pars_gen'] = ff2_sub_pars_gen
 biology2['exact'] = ff2_exact
+biology2['bmf_fun_vec'] = ff2_bmf_fun_vec
+biology2['sub_pars_gen_vec'] = ff2_sub_pars_gen_vec
 #biology2['version'] ='v0.2'
 biology2['biol_id'] = 1 #}}}
 
@@ -975,21 +1361,73 @@ def ff3_sub_pars_gen(prot_prot_pars,
     height_trunc = ff_cohort_pars['height_trunc']
 
     def alpha_gen():
-        x = -1000000
-        while x < alpha_trunc:
-            x = random.gauss(alpha_mu, alpha_sd)
-        return x
+        return truncNormal(alpha_mu, alpha_sd, alpha_trunc)
 
     def beta_gen():
-        x = -1000000
-        while x < beta_trunc:
-            x = random.gauss(beta_mu, beta_sd)
-        return x
+        return truncNormal(beta_mu, beta_sd, beta_trunc)
+
+    def height_gen():
+        # The original rejection loop returned its first draw, so height_trunc
+        # has never been applied. Kept that way so old runs stay comparable.
+        return random.gauss(height_mu, height_sd)
+
+    results = odict()
+    results['alpha'] = alpha_gen()
+    results['beta'] = beta_gen()
+    results['height'] = height_gen()
+
+    return results #}}}
+
+def ff3_bmf_fun_vec(ff_cohort_pars,
+        ff_sub_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        t): #{{{
+
+    alpha = ff_sub_pars['alpha']
+    beta = ff_sub_pars['beta']
+    height = ff_sub_pars['height']
+    seroconversion_date = prot_sub_pars['seroconversion_date']
+    ea = ff_cohort_pars['ea']
+    eb = ff_cohort_pars['eb']
+    ec = ff_cohort_pars['ec']
+    ed = ff_cohort_pars['ed']
+
+    Z = height*(1 - np.exp(-(np.exp(-beta)*(t - seroconversion_date))**alpha))
+    error_term = (eb*(Z**ea) + ec*(Z) + ed) * np.random.standard_normal(len(t))
+
+    if options.restrictBMV:
+        return np.maximum(0, Z + error_term)
+    else:
+        return Z + error_term
+    #}}}
+
+def ff3_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+
+    alpha_mu = ff_cohort_pars['alpha_mu']
+    alpha_sd = ff_cohort_pars['alpha_sd']
+    alpha_trunc = ff_cohort_pars['alpha_trunc']
+    beta_mu = ff_cohort_pars['beta_mu']
+    beta_sd = ff_cohort_pars['beta_sd']
+    beta_trunc = ff_cohort_pars['beta_trunc']
+    height_mu = ff_cohort_pars['height_mu']
+    height_sd = ff_cohort_pars['height_sd']
+
+    def alpha_gen():
+        return truncNormal(alpha_mu, alpha_sd, alpha_trunc, nsubs)
+
+    def beta_gen():
+        return truncNormal(beta_mu, beta_sd, beta_trunc, nsubs)
 
     def height_gen():
-        x = -1000000
-        while x < height_trunc:
-            return random.gauss(height_mu, height_sd)
+        # ff3_sub_pars_gen returns the first draw of height, i.e. height_trunc
+        # is never applied. Keep it that way so both engines agree.
+        return np.random.normal(height_mu, height_sd, nsubs)
 
     results = odict()
     results['alpha'] = alpha_gen()
@@ -1021,6 +1459,8 @@ biology3['bmf_fun'] = ff3_bmf_fun
 biology3['cohort_pars_gen'] = ff3_cohort_pars_gen
 biology3['sub_pars_gen'] = ff3_sub_pars_gen
 biology3['exact'] = ff3_exact
+biology3['bmf_fun_vec'] = ff3_bmf_fun_vec
+biology3['sub_pars_gen_vec'] = ff3_sub_pars_gen_vec
 biology3['version'] = 'v1.0'
 biology3['biol_id'] = 2 #}}}
 
@@ -1199,6 +1639,49 @@ def ff5_sub_pars_gen(prot_prot_pars,
 
     return results #}}}
 
+def ff5_bmf_fun_vec(ff_cohort_pars,
+        ff_sub_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        t): #{{{
+
+    sigma = ff_cohort_pars['sigma']
+    slope = ff_sub_pars['slope']
+    intercept = ff_sub_pars['intercept']
+
+    error_term = sigma * np.random.standard_normal(len(t))
+    Z = intercept + slope * t
+
+    if options.restrictBMV:
+        return np.maximum(0, Z + error_term)
+    else:
+        return Z + error_term
+    #}}}
+
+def ff5_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+
+    dist = ff_cohort_pars['dist']
+    dist_params = ff_cohort_pars['dist_params']
+    sc = prot_sub_pars['seroconversion_date']
+
+    if dist == "normal":
+        mu, sd = [float(i) for i in dist_params.split(',')]
+        crossing_times = mu + sd * np.random.standard_normal(nsubs)
+
+    slope = 1/crossing_times
+    intercept = -slope*sc
+
+    results = odict()
+    results['slope'] = slope
+    results['intercept'] = intercept
+
+    return results #}}}
+
 biology5 = Biology(id = 4, 
         version = "v0.1", 
         table = bioObj, 
@@ -1224,6 +1707,8 @@ biology5 = Biology(id = 4,
 biology5['bmf_fun'] = ff5_bmf_fun
 biology5['cohort_pars_gen'] = ff5_cohort_pars_gen
 biology5['sub_pars_gen'] = ff5_sub_pars_gen
+biology5['bmf_fun_vec'] = ff5_bmf_fun_vec
+biology5['sub_pars_gen_vec'] = ff5_sub_pars_gen_vec
 biology5['version'] = "v0.1"
 biology5['biol_id'] = 4 #}}}
 
@@ -1265,14 +1750,10 @@ def ff6_cohort_pars_gen(prot_prot_pars,
 
     return bioObj.load_set(biol_id, version, param_set)[1] #}}}
 
-def ff6_sub_pars_gen(prot_prot_pars, 
-        prot_cohort_pars, 
-        prot_sub_pars, 
-        ff_cohort_pars, 
-        cohort_id, 
-        sub_id, 
-        fun = True): #{{{
-
+def ff6_mvn_pars(ff_cohort_pars): #{{{
+    """
+    The mean vector and covariance matrix of (alpha, beta, gamma, delta)
+    """
     alpha_mu = ff_cohort_pars['alpha_mu']
     alpha_sd = ff_cohort_pars['alpha_sd']
     alpha_beta_sd = ff_cohort_pars['alpha_beta_sd']
@@ -1295,14 +1776,25 @@ def ff6_sub_pars_gen(prot_prot_pars,
             [alpha_gamma_sd,  beta_gamma_sd,   gamma_sd**2,        gamma_delta_sd],
             [alpha_delta_sd,  beta_delta_sd,   gamma_delta_sd,  delta_sd**2]]
 
+    return mymeans, mycov #}}}
+
+def ff6_sub_pars_gen(prot_prot_pars, 
+        prot_cohort_pars, 
+        prot_sub_pars, 
+        ff_cohort_pars, 
+        cohort_id, 
+        sub_id, 
+        fun = True): #{{{
+
     def accRejSam():
         done = False
         while not done:
-            x = np.random.multivariate_normal(mymeans, mycov,1)
+            x = mvnDraws(mymeans, mycov, 1)
             if (x[0][1]>0) and (x[0][2]>0) and (x[0][3]>0) and (x[0][3]>x[0][0]):
                 done = True
         return x
 
+    mymeans, mycov = ff6_mvn_pars(ff_cohort_pars)
     alpha, beta, gamma, delta = list(accRejSam()[0])
 
     results = odict()
@@ -1313,7 +1805,67 @@ def ff6_sub_pars_gen(prot_prot_pars,
 
     return results #}}}
 
+def ff6_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+    """
+    Draws the candidates of the whole cohort in batches and keeps the
+    accepted ones in the order they were drawn, so the subjects get the
+    same values as nsubs calls to ff6_sub_pars_gen
+    """
+    mymeans, mycov = ff6_mvn_pars(ff_cohort_pars)
+
+    accepted = []
+    naccepted = 0
+    ndrawn = 0
+    while naccepted < nsubs:
+        # size the batch with the acceptance rate seen so far
+        rate = max(naccepted, 1) / float(max(ndrawn, 1))
+        x = mvnDraws(mymeans, mycov, int(math.ceil((nsubs - naccepted) / rate)))
+        ndrawn += len(x)
+        x = x[(x[:,1]>0) & (x[:,2]>0) & (x[:,3]>0) & (x[:,3]>x[:,0])]
+        accepted.append(x)
+        naccepted += len(x)
+    x = np.concatenate(accepted)[:nsubs]
+
+    results = odict()
+    results['alpha'] = x[:,0]
+    results['beta'] = x[:,1]
+    results['gamma'] = x[:,2]
+    results['delta'] = x[:,3]
+
+    return results #}}}
+
+def ff6_bmf_fun_vec(ff_cohort_pars,
+        ff_sub_pars,
+        prot_cohort_pars,
+        prot_sub_pars,
+        t): #{{{
+
+    alpha = ff_sub_pars['alpha']
+    beta = ff_sub_pars['beta']
+    gamma = ff_sub_pars['gamma']
+    delta = ff_sub_pars['delta']
+    e0 = ff_cohort_pars['e0']
+    e1 = ff_cohort_pars['e1']
+    e2 = ff_cohort_pars['e2']
+    e3 = ff_cohort_pars['e3']
+    seroconversion_date = prot_sub_pars['seroconversion_date']
+
+    Z = ((alpha - delta)/(1+(((t-seroconversion_date)/gamma)**beta)))+delta
+    error_term = (e2*(Z**e3) + e1*(Z) + e0) * np.random.standard_normal(len(t))
+
+    if options.restrictBMV:
+        return np.maximum(0, Z + error_term)
+    else:
+        return Z + error_term
+    #}}}
+
 def ff6_exact(biol_id, version, param_set, method = "quad", threshold = 0, bigT = 365):
+    import scipy.stats, scipy.integrate
 
     def evalBMFnoNoise(t, beta, gamma, delta, seroconversion_date = 0):
         print beta, gamma, delta
@@ -1454,6 +2006,8 @@ biology6['bmf_fun'] = ff6_bmf_fun
 biology6['cohort_pars_gen'] = ff6_cohort_pars_gen
 biology6['sub_pars_gen'] = ff6_sub_pars_gen
 biology6['exact'] = ff6_exact
+biology6['bmf_fun_vec'] = ff6_bmf_fun_vec
+biology6['sub_pars_gen_vec'] = ff6_sub_pars_gen_vec
 biology6['version'] = 'v1.1'
 biology6['biol_id'] = 6 #}}}
 
@@ -1507,6 +2061,26 @@ biologiesD = {'biology0':biology1,
 #   Basically, it only returns:
 #   1) Was this the subjects last visit?
 #   2) If not, when is the next visit
+# The numpy engine (--engine=numpy) first generates all the visit dates of a
+#   cohort and only then computes the biomarker values for all the visits at
+#   once. Protocols whose visits depend on the biomarker values (e.g. exit
+#   when the biomarker is above a threshold) must set
+#   protocolx['bmv_dependent_visits'] = True so that the numpy engine
+#   computes the biomarker value of each visit before the next one is generated.
+# Like the biologies, a protocol can supply px_sub_pars_gen_vec to simulate
+#   the subject level parameters of a whole cohort at once.
+# A protocol whose visit dates only depend on the subject parameters can
+#   also supply px_visit_schedule_gen_vec, which the numpy engine calls
+#   instead of calling px_vis_par_gen once per visit. It returns the subject
+#   index, visit_id and visit_date of every attended visit of the cohort as
+#   arrays, ordered by subject and visit_id.
+# A protocol with bmv_dependent_visits can supply px_visit_step_gen_vec
+#   instead. The numpy engine then moves all the subjects of a cohort that
+#   are still in follow-up on by one visit at a time: px_visit_step_gen_vec
+#   gets the date and biomarker value of their previous visit and returns
+#   whether the next visit is their last and its date, the biomarker values
+#   of the new visits are computed at once and the subjects that are done
+#   leave the active set.
 # }}}
 
 # The protocol shared function pool {{{
@@ -1537,6 +2111,24 @@ def tmp(alpha, beta, ti1):
 
 prot_sub['sc_date_gen_2'] = tmp
 
+def tmp(fpv):
+    """
+    sc_date_gen_1 for an array of first positive visits
+    """
+    if (fpv <= 0).any():
+        raise ValueError("fpv <= 0 ERROR!")
+    return np.random.uniform(0, fpv - 1)
+
+prot_sub['sc_date_gen_1_vec'] = tmp
+
+def tmp(alpha, beta, ti1):
+    """
+    sc_date_gen_2 for an array of first positive visits
+    """
+    return ti1*np.random.beta(alpha, beta, len(ti1))
+
+prot_sub['sc_date_gen_2_vec'] = tmp
+
 def tmp(vmpnMu, vmpnSigma):
     """
     Generate the probability of missing a visit while
@@ -1560,14 +2152,7 @@ def tmp(vgnMu, vgnSigma):
     Generate the gap between subsequent visits while
     Subject is HIV negative
     """
-    done = False
-    while not done:
-        xasdf = random.gauss(vgnMu, vgnSigma)
-        #print vgnMu, vgnSigma
-        #print xasdf, 1
-        if xasdf >= 0.0:
-            done = True
-    return xasdf
+    return truncNormal(vgnMu, vgnSigma, 0.0)
 
 prot_sub['vgn_gen_1'] = tmp
 
@@ -1586,25 +2171,65 @@ def tmp(fpv_cutoff, vmpn, vgnMu, vgnSigma):
     return fpv
 
 prot_sub['fpv_gen_1'] = tmp
-# }}}
 
-# The visit level functions of the protocol shared function pool {{{
-prot_vis = {}
+def tmp(vmpn):
+    """
+    The number of visits each subject misses before the first visit they
+    attend: every visit is missed with probability vmpn (an array), so the
+    number of misses is geometric. This is the number of times the
+    'while random.uniform(0,1) < vmpn' loops go round.
+    """
+    vmpn = np.clip(vmpn, 0, 1)
+    return np.random.geometric(1 - vmpn) - 1
+
+prot_sub['missed_visits_gen_vec'] = tmp
+
+def tmp(fpv_cutoff, vmpn, vgnMu, vgnSigma):
+    """
+    fpv_gen_1 for a whole cohort, vmpn is an array with the probability of
+    missing a visit of every subject. Draws the number of missed visits of
+    every subject and then all the gaps of the cohort at once.
+    """
+    nvisits = prot_sub['missed_visits_gen_vec'](vmpn) + 1
+    gaps = truncNormal(vgnMu, vgnSigma, 0.0, nvisits.sum())
+    return np.bincount(np.repeat(np.arange(len(nvisits)), nvisits), weights = gaps, minlength = len(nvisits))
+
+prot_sub['fpv_gen_1_vec'] = tmp
+# }}}
+
+# The visit level functions of the protocol shared function pool {{{
+prot_vis = {}
 
 def tmp(vgpMu, vgpSigma):
     """
     Generate the gap between subsequent visits while
     Subject is HIV positive
     """
-    done = False
-    while not done:
-        xsdfg = random.gauss(vgpMu, vgpSigma)
-        #print xsdfg, 2
-        if xsdfg >= 0.0:
-            done = True
-    return xsdfg
+    return truncNormal(vgpMu, vgpSigma, 0.0)
 
 prot_vis['vgp_gen_1'] = tmp
+
+def subjectSegments(counts): #{{{
+    """
+    Lays out counts[i] entries for every subject i one after the other.
+    Returns the subject index and the position within the subject of every
+    entry, and where each subject's entries start
+    """
+    counts = np.asarray(counts, dtype = int)
+    starts = np.cumsum(counts) - counts
+    sub = np.repeat(np.arange(len(counts)), counts)
+    return sub, np.arange(counts.sum()) - starts[sub], starts
+    #}}}
+
+def segmentCumsum(x, counts): #{{{
+    """
+    The cumulative sums of x restarted at every subject
+    """
+    cs = np.cumsum(x)
+    counts = np.asarray(counts, dtype = int)
+    before = np.cumsum(counts) - counts
+    return cs - np.repeat(cs[before] - x[before], counts)
+    #}}}
 #}}}
 
 # }}}
@@ -1681,6 +2306,50 @@ def p1_sub_pars_gen(prot_prot_pars,
 
     return results #}}}
 
+def p1_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+
+    TMin = prot_cohort_pars['TMin']
+    TMax  = prot_cohort_pars['TMax']
+    ltfup  = prot_cohort_pars['ltfup']
+    alphasc  = prot_cohort_pars['alphasc']
+    betasc  = prot_cohort_pars['betasc']
+    vmpnAlpha  = prot_cohort_pars['vmpnAlpha']
+    vmpnBeta  = prot_cohort_pars['vmpnBeta']
+    vmppAlpha  = prot_cohort_pars['vmppAlpha']
+    vmppBeta  = prot_cohort_pars['vmppBeta']
+    vgnMu  = prot_cohort_pars['vgnMu']
+    vgnSigma  = prot_cohort_pars['vgnSigma']
+
+    sc_date_gen = prot_sub['sc_date_gen_2_vec']
+    fpv_gen = prot_sub['fpv_gen_1_vec']
+
+    def beta_gen(a, b):
+        try:
+            return np.random.beta(a, b, nsubs)
+        except ValueError:
+            return np.zeros(nsubs)
+
+    lost = np.random.uniform(size = nsubs) < ltfup # Are they lost to followup?
+    T = np.where(lost, np.random.uniform(TMin, TMax, nsubs), TMax)
+    vmpn = beta_gen(vmpnAlpha, vmpnBeta)
+    vmpp = beta_gen(vmppAlpha, vmppBeta)
+
+    fpv = fpv_gen(T, vmpn, vgnMu, vgnSigma)
+    seroconversion_date = sc_date_gen(alphasc, betasc, fpv)
+
+    results = odict()
+    results['seroconversion_date'] = seroconversion_date
+    results['T'] = T
+    results['vmpp'] = vmpp
+    results['vmpn'] = vmpn
+    results['fpv'] = fpv
+
+    return results #}}}
+
 def p1_prot_visit_pars_gen(prot_prot_pars,  
         prot_cohort_pars, 
         ff_cohort_pars, 
@@ -1725,6 +2394,70 @@ def p1_prot_visit_pars_gen(prot_prot_pars,
             visit_date = visits[-1][1]+x
             return [done, [visit_id, visit_date, None]] #}}}
 
+def p1_visit_schedule_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        ff_cohort_pars,
+        prot_sub_pars,
+        ff_sub_pars,
+        cohort_id,
+        nsubs): #{{{
+    """
+    The visits of the whole cohort as p1_prot_visit_pars_gen generates them.
+    Once a subject has attended k visits, every further scheduled visit is
+    missed with probability vmpp*(1+tau)**min(ninc, k-2) until one is
+    attended, so the number of vgp gaps to the next attended visit is
+    geometric. The dates only go up, so a subject's attended visits are the
+    ones up to T+fpv; the first visit after it is not recorded and ends the
+    subject. The visits are generated in blocks for every subject that has
+    not reached T+fpv yet, a block being about enough visits to get there.
+    """
+    vgpMu = prot_cohort_pars['vgpMu']
+    vgpSigma = prot_cohort_pars['vgpSigma']
+    tau = prot_cohort_pars['tau']
+    ninc = prot_cohort_pars['ninc']
+
+    fpv = np.asarray(prot_sub_pars['fpv'], dtype = float)
+    vmpp = np.asarray(prot_sub_pars['vmpp'], dtype = float)
+    bound = np.asarray(prot_sub_pars['T'], dtype = float) + fpv
+
+    # the first visit is at fpv
+    subs = [np.arange(nsubs)]
+    ids = [np.zeros(nsubs, dtype = int)]
+    dates = [fpv]
+
+    active = np.arange(nsubs)
+    last = fpv.copy()
+    nattended = np.ones(nsubs, dtype = int)
+    while len(active) > 0:
+        block = int(math.ceil(np.max(bound[active] - last[active]) / max(vgpMu, 1e-6))) + 1
+        block = min(block, 1000)
+        k = nattended[active][:, None] + np.arange(block)
+        miss = vmpp[active][:, None] * float(1 + tau)**np.minimum(ninc, k - 2)
+        certain = miss >= 1
+        nslots = np.random.geometric(np.where(certain, 1, 1 - np.clip(miss, 0, 1)))
+        gaps = truncNormal(vgpMu, vgpSigma, 0.0, nslots.sum())
+        call_gaps = np.bincount(np.repeat(np.arange(nslots.size), nslots.ravel()),
+                weights = gaps, minlength = nslots.size).reshape(nslots.shape)
+        # a subject that misses every visit never attends another one
+        call_gaps[certain] = np.inf
+        block_dates = last[active][:, None] + np.cumsum(call_gaps, axis = 1)
+        attended = block_dates <= bound[active][:, None]
+        rows, cols = np.nonzero(attended)
+        subs.append(active[rows])
+        ids.append(k[rows, cols])
+        dates.append(block_dates[rows, cols])
+        more = attended[:, -1]
+        last[active[more]] = block_dates[more, -1]
+        nattended[active] += block
+        active = active[more]
+
+    subs = np.concatenate(subs)
+    ids = np.concatenate(ids)
+    dates = np.concatenate(dates)
+    order = np.lexsort((ids, subs))
+    return subs[order], ids[order], dates[order]
+    #}}}
+
 protocol1 = Protocol(id=0, version="v2.2", table=protObj, parameters = [#{{{
         AnnotatedTextSetting(db_var_name = "cohort_sizes", name = "prot0_cohort_sizes", title = "Cohort sizes", default = 50, db_var_type = "Integer"),
         AnnotatedTextSetting(db_var_name = "TMin",name = "prot0_Tmin", title = "T minimum", default=0),
@@ -1746,7 +2479,9 @@ protocol1 = Protocol(id=0, version="v2.2", table=protObj, parameters = [#{{{
 protocol1['prot_pars_gen']       = p1_prot_pars_gen
 protocol1['cohort_pars_gen']     = p1_cohort_pars_gen
 protocol1['sub_pars_gen']        = p1_sub_pars_gen
+protocol1['sub_pars_gen_vec']    = p1_sub_pars_gen_vec
 protocol1['visit_pars_gen'] = p1_prot_visit_pars_gen
+protocol1['visit_schedule_gen_vec'] = p1_visit_schedule_gen_vec
 #}}}
 #}}}
 
@@ -1797,6 +2532,38 @@ def p2_sub_pars_gen(prot_prot_pars,
 
     return results #}}}
 
+def p2_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+
+    vgn_mu  = prot_cohort_pars['vgn_mu']
+    vgn_sd  = prot_cohort_pars['vgn_sd']
+    vmpn    = prot_cohort_pars['vmpn']
+    n_bin   = prot_cohort_pars['n_bin']
+    p_bin   = prot_cohort_pars['p_bin']
+
+    sc_date_gen = prot_sub['sc_date_gen_1_vec']
+
+    def fpv_gen(vmpn, vgn_mu, vgn_sd):
+        # The gaps are not truncated, so the sum of the k gaps up to the
+        # first attended visit is normal with mean k*vgn_mu and variance
+        # k*vgn_sd**2
+        k = prot_sub['missed_visits_gen_vec'](np.repeat(vmpn, nsubs)) + 1
+        return np.random.normal(k*vgn_mu, np.sqrt(k)*vgn_sd)
+
+    n_visits = numpy.random.binomial(n_bin, p_bin, nsubs)
+    fpv = fpv_gen(vmpn, vgn_mu, vgn_sd)
+    seroconversion_date = sc_date_gen(fpv)
+
+    results = odict()
+    results['seroconversion_date'] = seroconversion_date
+    results['fpv'] = fpv
+    results['n_visits'] = n_visits
+
+    return results #}}}
+
 def p2_prot_visit_pars_gen(prot_prot_pars,  
         prot_cohort_pars, 
         ff_cohort_pars, 
@@ -1835,6 +2602,58 @@ def p2_prot_visit_pars_gen(prot_prot_pars,
             done = True
     return [done, [visit_id, visit_date, visit_status]] #}}}
 
+def p2_visit_schedule_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        ff_cohort_pars,
+        prot_sub_pars,
+        ff_sub_pars,
+        cohort_id,
+        nsubs): #{{{
+    """
+    The visits of the whole cohort as p2_prot_visit_pars_gen generates them:
+    after the first visit (at fpv) every visit is missed with probability
+    vmpp. A missed visit uses up its visit_id, but its date is discarded:
+    the next visit is a vgp gap after the last attended one. Visits are
+    scheduled until max(n_visits, 1) have been attended, and then once more.
+    The number of visits missed on the way is negative binomial and the
+    missed ones are spread at random over all but the last of those visits.
+    """
+    vgp_mu      = prot_cohort_pars['vgp_mu']
+    vgp_sd      = prot_cohort_pars['vgp_sd']
+    vmpp        = prot_cohort_pars['vmpp']
+    n_visits    = np.asarray(prot_sub_pars['n_visits'])
+    fpv         = np.asarray(prot_sub_pars['fpv'], dtype = float)
+
+    needed = np.maximum(n_visits, 1).astype(int) - 1
+    missed = np.zeros(nsubs, dtype = int)
+    some = needed > 0
+    if some.any():
+        missed[some] = np.random.negative_binomial(needed[some], 1 - vmpp)
+
+    # visit 0, the visits up to the last needed one and the last visit
+    nvisits = 1 + needed + missed + 1
+    sub, visit_ids = subjectSegments(nvisits)[:2]
+    last = visit_ids == nvisits[sub] - 1
+    last_needed = (visit_ids == nvisits[sub] - 2) & (needed[sub] > 0)
+    attended = np.ones(len(sub), dtype = bool)
+    attended[last] = np.random.uniform(size = nsubs) >= vmpp
+    # only subjects that miss visits need them shuffled
+    between = (visit_ids > 0) & ~last & ~last_needed & (missed[sub] > 0)
+    between_sub = sub[between]
+    order = np.lexsort((np.random.uniform(size = len(between_sub)), between_sub))
+    rank = np.arange(len(order)) - np.searchsorted(between_sub, between_sub[order])
+    between_missed = np.empty(len(order), dtype = bool)
+    between_missed[order] = rank < missed[between_sub[order]]
+    attended[np.flatnonzero(between)[between_missed]] = False
+
+    sub, visit_ids = sub[attended], visit_ids[attended]
+    gaps = np.zeros(len(sub))
+    later = visit_ids > 0
+    gaps[later] = truncNormal(vgp_mu, vgp_sd, 0.0, later.sum()) # prot_vis['vgp_gen_1']
+    visit_dates = fpv[sub] + segmentCumsum(gaps, np.bincount(sub, minlength = nsubs))
+    return sub, visit_ids, visit_dates
+    #}}}
+
 protocol2 = Protocol(id=2, version='v0.2', table = protObj, parameters = [
     AnnotatedTextSetting(name="prot1_cohort_sizes", title="Cohort sizes", default = 30, db_var_name = "cohort_sizes", db_var_type = "Integer"),
     AnnotatedTextSetting(name="prot1_n_bin", title = "n Binomial", default = 10, db_var_name = "n_bin"),
@@ -1849,7 +2668,9 @@ protocol2 = Protocol(id=2, version='v0.2', table = protObj, parameters = [
 protocol2['prot_pars_gen']       = p2_prot_pars_gen
 protocol2['cohort_pars_gen']     = p2_cohort_pars_gen
 protocol2['sub_pars_gen']        = p2_sub_pars_gen
+protocol2['sub_pars_gen_vec']    = p2_sub_pars_gen_vec
 protocol2['visit_pars_gen'] = p2_prot_visit_pars_gen
+protocol2['visit_schedule_gen_vec'] = p2_visit_schedule_gen_vec
    #}}}
 
 # Specify protocol3 - Exit when biomarker > threshold {{{
@@ -1911,6 +2732,39 @@ def p3_sub_pars_gen(prot_prot_pars,
 
     return results #}}}
 
+def p3_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+
+    vmpnMu  = prot_cohort_pars['vmpnMu']
+    vmpnSigma  = prot_cohort_pars['vmpnSigma']
+    vmppMu  = prot_cohort_pars['vmppMu']
+    vmppSigma  = prot_cohort_pars['vmppSigma']
+    vgnMu  = prot_cohort_pars['vgnMu']
+    vgnSigma  = prot_cohort_pars['vgnSigma']
+
+    fpv_cutoff = 300
+
+    sc_date_gen = prot_sub['sc_date_gen_1_vec']
+    fpv_gen = prot_sub['fpv_gen_1_vec']
+
+    vmpn = np.random.normal(vmpnMu, vmpnSigma, nsubs)
+    fpv = fpv_gen(fpv_cutoff, vmpn, vgnMu, vgnSigma)
+    seroconversion_date = sc_date_gen(fpv)
+    vmpp = np.random.normal(vmppMu, vmppSigma, nsubs)
+    last_visit_prob = np.random.normal(0.15, 0.015, nsubs)
+
+    results = odict()
+    results['seroconversion_date'] = seroconversion_date
+    results['last_visit_prob'] = last_visit_prob
+    results['vmpn'] = vmpn
+    results['vmpp'] = vmpp
+    results['fpv'] = fpv
+
+    return results #}}}
+
 def p3_prot_visit_pars_gen(prot_prot_pars, 
         prot_cohort_pars, 
         ff_cohort_pars, 
@@ -1956,6 +2810,40 @@ def p3_prot_visit_pars_gen(prot_prot_pars,
         #visit_date = round(visits[-1][1]+x) old rounding code
     return [done, [visit_id, visit_date, None]] #}}}
 
+def p3_visit_step_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        ff_cohort_pars,
+        prot_sub_pars,
+        ff_sub_pars,
+        active,
+        last_dates,
+        last_bmvs,
+        cohort_id,
+        visit_id): #{{{
+    """
+    p3_prot_visit_pars_gen for all the subjects still in follow-up at once.
+    active indexes the subject parameter columns, last_dates and last_bmvs
+    are the date and biomarker value of their previous visit.
+    Returns whether each visit is the subject's last and the visit dates
+    """
+    vgpMu  = prot_cohort_pars['vgpMu']
+    vgpSigma = prot_cohort_pars['vgpSigma']
+    threshold_mult = prot_cohort_pars['threshold_mult']
+    assay_threshold = ff_cohort_pars['assay_threshold']
+
+    nactive = len(active)
+    if visit_id == 0:
+        return np.zeros(nactive, dtype = bool), prot_sub_pars['fpv'][active]
+
+    done = np.random.uniform(size = nactive) < prot_sub_pars['last_visit_prob'][active]
+    done |= last_bmvs > threshold_mult * assay_threshold
+    # A gap for the visit and one for every missed visit before it
+    ngaps = prot_sub['missed_visits_gen_vec'](prot_sub_pars['vmpp'][active]) + 1
+    gaps = truncNormal(vgpMu, vgpSigma, 0.0, ngaps.sum()) # prot_vis['vgp_gen_1']
+    x = np.bincount(np.repeat(np.arange(nactive), ngaps), weights = gaps, minlength = nactive)
+    return done, last_dates + x
+    #}}}
+
 protocol3 = Protocol(id=1, version='v0.2', table=protObj, parameters=[])
 #AnnotatedTextSetting(name = "prot2_cohort_sizes"], title = "Cohort sizes", defaul = 30, db_var_name = "cohort_sizes", db_var_type = "Integer")
 #AnnotatedTextSetting(name = "prot2_vmpnMu", title = "VMPN mu" , default = 0.2, db_var_name = "vmpnMu")
@@ -1970,7 +2858,10 @@ protocol3 = Protocol(id=1, version='v0.2', table=protObj, parameters=[])
 protocol3['prot_pars_gen']       = p3_prot_pars_gen
 protocol3['cohort_pars_gen']     = p3_cohort_pars_gen
 protocol3['sub_pars_gen']        = p3_sub_pars_gen
-protocol3['visit_pars_gen'] = p3_prot_visit_pars_gen #}}}
+protocol3['sub_pars_gen_vec']    = p3_sub_pars_gen_vec
+protocol3['visit_pars_gen'] = p3_prot_visit_pars_gen
+protocol3['bmv_dependent_visits'] = True
+protocol3['visit_step_gen_vec'] = p3_visit_step_gen_vec #}}}
 
 # Specify protocol4 - Fixed number of REALIZED visits {{{
 def p4_prot_pars_gen(): #{{{
@@ -2018,6 +2909,32 @@ def p4_sub_pars_gen(prot_prot_pars,
 
     return results #}}}
 
+def p4_sub_pars_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        ff_cohort_pars,
+        cohort_id,
+        nsubs): #{{{
+
+    vgn_lb   = prot_cohort_pars['vgn_lb']
+    vgn_ub   = prot_cohort_pars['vgn_ub']
+
+    vgp_time_dep_lb    = prot_cohort_pars['vgp_time_dep_lb']
+    vgp_time_dep_ub    = prot_cohort_pars['vgp_time_dep_ub']
+
+    vgp_time_dep = np.random.uniform(vgp_time_dep_lb, vgp_time_dep_ub, nsubs)
+
+    sc_date_gen = prot_sub['sc_date_gen_1_vec']
+
+    fpv = np.random.uniform(vgn_lb, vgn_ub, nsubs)
+    seroconversion_date = sc_date_gen(fpv)
+
+    results = odict()
+    results['seroconversion_date'] = seroconversion_date
+    results['fpv'] = fpv
+    results['vgp_time_dep'] = vgp_time_dep
+
+    return results #}}}
+
 def p4_prot_visit_pars_gen(prot_prot_pars,  
         prot_cohort_pars, 
         ff_cohort_pars, 
@@ -2063,6 +2980,36 @@ def p4_prot_visit_pars_gen(prot_prot_pars,
             done = True
     return [done, [visit_id, visit_date, visit_status]] #}}}
 
+def p4_visit_schedule_gen_vec(prot_prot_pars,
+        prot_cohort_pars,
+        ff_cohort_pars,
+        prot_sub_pars,
+        ff_sub_pars,
+        cohort_id,
+        nsubs): #{{{
+    """
+    The visits of the whole cohort as p4_prot_visit_pars_gen generates them:
+    max(n_visits, 2) visits, the first at fpv. The k'th gap is gamma
+    distributed with mean vgp_mu*f**k and variance vgp_sd*f**k in the
+    parametrisation of vgp_gen (shape vgp_mu**2*f**k/vgp_sd, scale
+    vgp_sd/vgp_mu), where f is the subject's vgp_time_dep.
+    """
+    vgp_mu          = prot_cohort_pars['vgp_mu']
+    vgp_sd          = prot_cohort_pars['vgp_sd']
+    n_visits        = prot_cohort_pars['n_visits']
+    vgp_time_dep    = np.asarray(prot_sub_pars['vgp_time_dep'], dtype = float)
+    fpv             = np.asarray(prot_sub_pars['fpv'], dtype = float)
+
+    nvisits = np.repeat(max(int(math.ceil(n_visits)), 2), nsubs)
+    sub, visit_ids = subjectSegments(nvisits)[:2]
+    gaps = np.zeros(len(sub))
+    later = visit_ids > 0
+    beta = vgp_sd/float(vgp_mu)
+    gaps[later] = np.random.gamma(vgp_mu * vgp_time_dep[sub[later]]**visit_ids[later] / beta, beta)
+    visit_dates = fpv[sub] + segmentCumsum(gaps, nvisits)
+    return sub, visit_ids, visit_dates
+    #}}}
+
 protocol4 = Protocol(id=3, version='v0.1', table = protObj, parameters = [
     AnnotatedTextSetting(name="prot4_cohort_sizes", title="Cohort sizes", default = 10, db_var_name = "cohort_sizes", db_var_type = "Integer"),
     AnnotatedTextSetting(name="prot4_vgp_mu", title = "Visit Gap while Positive: Mu", default = 50, db_var_name = "vgp_mu"),
@@ -2076,11 +3023,13 @@ protocol4 = Protocol(id=3, version='v0.1', table = protObj, parameters = [
 protocol4['prot_pars_gen']       = p4_prot_pars_gen
 protocol4['cohort_pars_gen']     = p4_cohort_pars_gen
 protocol4['sub_pars_gen']        = p4_sub_pars_gen
+protocol4['sub_pars_gen_vec']    = p4_sub_pars_gen_vec
 protocol4['visit_pars_gen'] = p4_prot_visit_pars_gen
+protocol4['visit_schedule_gen_vec'] = p4_visit_schedule_gen_vec
    #}}}
 
 protocolsD = {'prot0':protocol1,
-#        'prot1':protocol3,
+        'prot1':protocol3,
         'prot3':protocol4,
         'prot2':protocol2}
 # }}}
@@ -2096,9 +3045,10 @@ def createTable(name, header): # {{{
     (
     """ %(name,)
     for i in header:
+        # A version column's name ends with version: seroconversion_date is a double
         if i.count("id") == 1:
             colType = "int"
-        elif (i.count("version") == 1) or (i == "prot_param_set") or (i == "bio_param_set"):
+        elif i.endswith("version") or (i == "prot_param_set") or (i == "bio_param_set"):
             colType = "varchar(50)"
         else:
             colType = "double"
@@ -2119,151 +3069,991 @@ def insertData(name, data): #{{{
     """%(name, ",".join([dontQuoteNulls(bam) for bam in data]))
     return qstring #}}}
 
-def roundVisitDates(name, roundit = True): # {{{
-    if roundit:
-        return """update %s set visit_date = round(visit_date,0)"""%name
+def insertManyData(name, ncols): #{{{
+    """
+    Parameterised version of insertData for use with executemany.
+    MySQLdb rewrites an executemany of this statement into a single
+    multi-row INSERT
+    """
+    qstring = """
+    INSERT INTO %s VALUES (%s)
+    """%(name, ",".join(["%s"]*ncols))
+    return qstring #}}}
+
+def nullsToNone(x):
+    if x == "null":
+        return None
     else:
-        return """update %s set visit_date = visit_date"""%name
+        return x
+
+class RunTableWriter(object): #{{{
+    """
+    Storage backend for the run tables (prottab, cohorttab, subtab and
+    visittab). simulateCohorts only talks to the tables through these
+    methods:
+
+        create_table(name, header)  - a new table with these columns
+        insert_row(name, row)       - a row of the table
+        insert_rows(name, rows)     - an iterable of rows
+        commit()                    - called once per cohort
+        finish()                    - called once all cohorts are simulated
+
+    Rows are buffered and handed to write_rows batch_size rows at a time.
+    Subclasses implement write_rows and, if needed,
+    create_table, commit and finish. sinksD maps the --sink names to the
+    backends.
+    """
+
+    def __init__(self, batch_size = 1000, out_dir = None, compress = None):
+        self.batch_size = batch_size
+        self.out_dir = out_dir
+        self.compress = compress
+        self.headers = odict()
+        self.buffers = odict()
+
+    def create_table(self, name, header):#{{{
+        self.headers[name] = list(header)
+        self.buffers[name] = []
+        #}}}
+
+    def insert_row(self, name, row):#{{{
+        buf = self.buffers[name]
+        buf.append([nullsToNone(x) for x in row])
+        if len(buf) >= self.batch_size:
+            self.flush(name)
+        #}}}
+
+    def insert_rows(self, name, rows):#{{{
+        for row in rows:
+            self.insert_row(name, row)
+        #}}}
+
+    def flush(self, name = None):#{{{
+        if name is None:
+            names = self.buffers.keys()
+        else:
+            names = [name]
+        for name in names:
+            if len(self.buffers[name]) > 0:
+                self.write_rows(name, self.buffers[name])
+                self.buffers[name] = []
+        #}}}
+
+    def write_rows(self, name, rows):#{{{
+        raise NotImplementedError
+        #}}}
+
+    def commit(self):#{{{
+        self.flush()
+        #}}}
+
+    def finish(self):#{{{
+        """
+        Called once all the cohorts have been simulated
+        """
+        self.commit()
+        #}}}
+
+    def cleanup(self):#{{{
+        """
+        Called when the run ends, also when it fails: removes any
+        temporary files that are left
+        """
+        pass
+        #}}}
+    #}}}
+
+class MySQLTableWriter(RunTableWriter): #{{{
+    """
+    Writes the run tables to the database batch_size rows at a time
+    with executemany instead of one INSERT per row.
+    Nothing is committed until commit is called - simulateCohorts does
+    this once per cohort.
+    """
+
+    def create_table(self, name, header):#{{{
+        con.execute(createTable(name, header))
+        RunTableWriter.create_table(self, name, header)
+        #}}}
+
+    def write_rows(self, name, rows):#{{{
+        con.executemany(insertManyData(name, len(self.headers[name])), rows)
+        #}}}
+
+    def commit(self):#{{{
+        self.flush()
+        db.commit()
+        #}}}
+    #}}}
+
+def fieldString(x):
+    if x is None or x == "null":
+        return "\\N"
+    elif isinstance(x, float):
+        return repr(x)
+    else:
+        return str(x)
+
+def rowString(row):
+    return "|".join([fieldString(x) for x in row]) + "\n"
+
+class LoadDataTableWriter(MySQLTableWriter): #{{{
+    """
+    Streams the rows of each run table to a local pipe delimited temporary
+    file (in out_dir if given) while simulating. When the run is finished
+    each file is loaded into its table with a single LOAD DATA LOCAL INFILE,
+    which is much faster than INSERTing multi-million row visit tables.
+    """
+
+    def __init__(self, batch_size = 1000, out_dir = None, compress = None):
+        MySQLTableWriter.__init__(self, batch_size, out_dir)
+        if out_dir is not None and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.files = odict()
+
+    def create_table(self, name, header):#{{{
+        MySQLTableWriter.create_table(self, name, header)
+        fd, path = tempfile.mkstemp(prefix = name + ".", suffix = ".txt", dir = self.out_dir)
+        self.files[name] = (os.fdopen(fd, 'w'), path)
+        #}}}
+
+    def write_rows(self, name, rows):#{{{
+        self.files[name][0].writelines([rowString(row) for row in rows])
+        #}}}
+
+    def commit(self):#{{{
+        self.flush()
+        #}}}
+
+    def finish(self):#{{{
+        self.flush()
+        for name in self.files.keys():
+            f, path = self.files[name]
+            f.close()
+            con.execute("""LOAD DATA LOCAL INFILE '%s' INTO TABLE %s
+                FIELDS TERMINATED BY '|' LINES TERMINATED BY '\\n'""" %(path, name))
+            db.commit()
+            os.remove(path)
+            del self.files[name]
+        #}}}
+
+    def cleanup(self):#{{{
+        for f, path in self.files.values():
+            f.close()
+            if os.path.exists(path):
+                os.remove(path)
+        self.files = odict()
+        #}}}
+    #}}}
+
+class FileTableWriter(RunTableWriter): #{{{
+    """
+    Writes each run table straight to <out_dir>/<table name>.txt without
+    going through MySQL. The files are pipe delimited with the column
+    names on the first line (like the train and test files written by
+    dbToFile.py) and NULLs written as \\N.
+    """
+
+    def __init__(self, batch_size = 1000, out_dir = None, compress = None):
+        if out_dir is None:
+            out_dir = "."
+        RunTableWriter.__init__(self, batch_size, out_dir, compress)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.files = odict()
+
+    def table_path(self, name):#{{{
+        return compressedName(os.path.join(self.out_dir, name + ".txt"), self.compress)
+        #}}}
+
+    def create_table(self, name, header):#{{{
+        RunTableWriter.create_table(self, name, header)
+        f = openOutput(self.table_path(name), self.compress)
+        f.write("|".join(header) + "\n")
+        self.files[name] = f
+        #}}}
+
+    def write_rows(self, name, rows):#{{{
+        self.files[name].writelines([rowString(row) for row in rows])
+        #}}}
+
+    def commit(self):#{{{
+        self.flush()
+        # a flush of a compressed stream would end a compression block
+        # every cohort
+        if self.compress in (None, "none"):
+            for f in self.files.values():
+                f.flush()
+        #}}}
+
+    def finish(self):#{{{
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        #}}}
+    #}}}
+
+def trainField(x):
+    """
+    Formats a value the way MySQL wrote the doubles of the train and test
+    files in tests/ (12 significant digits, no trailing .0)
+    """
+    if x is None or x == "null":
+        return "\\N"
+    elif isinstance(x, float):
+        return "%.12g" %x
+    else:
+        return str(x)
+
+tableKinds = ["prottab", "cohorttab", "subtab", "visittab"]
+
+def splitTableName(name): #{{{
+    """
+    Splits the name of a run table, <runid>_<kind>_<biol_id>_<prot_id>,
+    into (runid, kind, "<biol_id>_<prot_id>")
+    """
+    for kind in tableKinds:
+        tag = "_" + kind + "_"
+        if tag in name:
+            runid, fp = name.split(tag)
+            return runid, kind, fp
+    raise ValueError("%s is not the name of a run table" %name)
+    #}}}
+
+class TrainTestWriter(RunTableWriter): #{{{
+    """
+    Writes the denormalized train<b>_<p>.txt and test<b>_<p>.txt files of
+    dbToFile.py straight from the simulator into <out_dir>/<run name>/
+    (the run name is the runid without 'run_'), with the same headers.
+    Each visit is joined to its prottab, cohorttab and subtab rows as it is
+    written, so the run tables are never stored anywhere and only the rows
+    of the current cohort are kept in memory.
+    The rows come in cohort and subject order, so uncompressed files also
+    get the subject offset index of trainIndex.py (train<b>_<p>.txt.idx).
+    """
+
+    def __init__(self, batch_size = 1000, out_dir = None, compress = None):
+        if out_dir is None:
+            out_dir = "."
+        RunTableWriter.__init__(self, batch_size, out_dir, compress)
+        self.kinds = {}
+        self.prot_row = None
+        self.cohort_rows = {}
+        self.sub_rows = {}
+        self.train = None
+        self.test = None
+        self.train_index = None
+        self.test_index = None
+
+    def create_table(self, name, header):#{{{
+        RunTableWriter.create_table(self, name, header)
+        runid, kind, fp = splitTableName(name)
+        self.kinds[name] = kind
+        if kind == "prottab":
+            self.prot_name = name
+        elif kind == "cohorttab":
+            self.cohort_name = name
+        elif kind == "subtab":
+            self.sub_name = name
+        else:
+            self.open_files(runid, fp, name)
+        #}}}
+
+    def open_files(self, runid, fp, visit_name):#{{{
+        self.close_files()
+        if runid.startswith("run_"):
+            runName = runid[4:]
+        else:
+            runName = runid
+        run_dir = os.path.join(self.out_dir, runName)
+        if not os.path.isdir(run_dir):
+            os.makedirs(run_dir)
+
+        # The columns of the dbToFile.py join: the id columns of the visit
+        # followed by the columns without '_id' of every table
+        train_header = ["biol_id", "prot_id", "cohort_id", "sub_id", "visit_id"]
+        self.train_cols = []
+        for name in [self.prot_name, self.cohort_name, self.sub_name, visit_name]:
+            header = self.headers[name]
+            cols = [i for i in range(len(header)) if header[i].count("_id") == 0]
+            train_header += [header[i] for i in cols]
+            self.train_cols.append(cols)
+        visit_header = self.headers[visit_name]
+        self.visit_ids = [visit_header.index(i) for i in train_header[:5]]
+        self.open_outputs(run_dir, fp, train_header, visit_header)
+        #}}}
+
+    def open_outputs(self, run_dir, fp, train_header, visit_header):#{{{
+        train_path = os.path.join(run_dir, 'train%s.txt' %fp)
+        test_path = os.path.join(run_dir, 'test%s.txt' %fp)
+        train_header = "|".join(train_header) + "\n"
+        test_header = "|".join(visit_header) + "\n"
+        self.train = openOutput(compressedName(train_path, self.compress), self.compress)
+        self.train.write(train_header)
+        self.test = openOutput(compressedName(test_path, self.compress), self.compress)
+        self.test.write(test_header)
+        if self.compress is None or self.compress == "none":
+            self.train_index = TrainIndexWriter(train_path, len(train_header))
+            self.test_index = TrainIndexWriter(test_path, len(test_header))
+        #}}}
+
+    def close_files(self):#{{{
+        if self.train is not None:
+            self.train.close()
+            self.test.close()
+            self.train = None
+            self.test = None
+        if self.train_index is not None:
+            self.train_index.close()
+            self.test_index.close()
+            self.train_index = None
+            self.test_index = None
+        #}}}
+
+    def insert_row(self, name, row):#{{{
+        """
+        Only the visits are buffered, the other rows are kept for the join
+        """
+        kind = self.kinds[name]
+        if kind == "visittab":
+            RunTableWriter.insert_row(self, name, row)
+            return
+        row = [nullsToNone(x) for x in row]
+        header = self.headers[name]
+        if kind == "prottab":
+            self.prot_row = row
+        elif kind == "cohorttab":
+            self.cohort_rows[row[header.index("cohort_id")]] = row
+        else:
+            self.sub_rows[(row[header.index("cohort_id")], row[header.index("sub_id")])] = row
+        #}}}
+
+    def write_rows(self, name, rows):#{{{
+        header = self.headers[name]
+        cohort_col = header.index("cohort_id")
+        sub_col = header.index("sub_id")
+        prot_cols, cohort_cols, sub_cols, visit_cols = self.train_cols
+        train_rows = []
+        for row in rows:
+            cohort_row = self.cohort_rows[row[cohort_col]]
+            sub_row = self.sub_rows[(row[cohort_col], row[sub_col])]
+            train_rows.append([row[i] for i in self.visit_ids] +
+                    [self.prot_row[i] for i in prot_cols] +
+                    [cohort_row[i] for i in cohort_cols] +
+                    [sub_row[i] for i in sub_cols] +
+                    [row[i] for i in visit_cols])
+        self.write_outputs(train_rows, rows)
+        #}}}
+
+    def write_outputs(self, train_rows, test_rows):#{{{
+        train_lines = ["|".join([trainField(x) for x in row]) + "\n" for row in train_rows]
+        test_lines = ["|".join([trainField(x) for x in row]) + "\n" for row in test_rows]
+        self.train.writelines(train_lines)
+        self.test.writelines(test_lines)
+        if self.train_index is not None:
+            for row, train_line, test_line in zip(train_rows, train_lines, test_lines):
+                self.train_index.add(row[2], row[3], len(train_line))
+                self.test_index.add(row[2], row[3], len(test_line))
+        #}}}
+
+    def commit(self):#{{{
+        """
+        Called after every cohort - its rows are no longer needed
+        """
+        self.flush()
+        self.cohort_rows = {}
+        self.sub_rows = {}
+        #}}}
+
+    def finish(self):#{{{
+        self.commit()
+        self.close_files()
+        #}}}
+    #}}}
+
+class TrainColumnsWriter(TrainTestWriter): #{{{
+    """
+    Like TrainTestWriter, but writes the train rows to the binary column
+    store <out_dir>/<run name>/train<b>_<p>.columns/ (see columnStore.py)
+    instead of text files. The test columns are a subset of the train
+    columns, so no separate test store is written.
+    """
+
+    def open_outputs(self, run_dir, fp, train_header, visit_header):#{{{
+        self.train = columnStore.ColumnStoreWriter(os.path.join(run_dir, 'train%s.columns' %fp), train_header,
+                columnStore.stringParameters(con))
+        #}}}
+
+    def write_outputs(self, train_rows, test_rows):#{{{
+        self.train.append_rows(train_rows)
+        #}}}
+
+    def close_files(self):#{{{
+        if self.train is not None:
+            self.train.close()
+            self.train = None
+        #}}}
+    #}}}
+
+sinksD = {'insert': MySQLTableWriter,
+        'loaddata': LoadDataTableWriter,
+        'files': FileTableWriter,
+        'train': TrainTestWriter,
+        'columns': TrainColumnsWriter}
+
+def iterRows(columns, chunk = 10000): # {{{
+    """
+    Yields the rows of an odict of columns (lists or numpy arrays)
+    Works through the columns in chunks so that a large cohort is never
+    turned into python rows all at once
+    """
+    if len(columns) == 0:
+        return
+    nrows = len(columns.values()[0])
+    for start in range(0, nrows, chunk):
+        cols = []
+        for col in columns.values():
+            col = col[start:start+chunk]
+            if isinstance(col, np.ndarray):
+                col = col.tolist()
+            cols.append(col)
+        for row in itertools.izip(*cols):
+            yield row
     #}}}
 
 #}}}
 
-def simulateCohorts(biologies, biolParSets, protocols, protParSets, ncohorts_input = -1): # {{{
+# The cohort engines {{{
+
+# Description {{{
+# A cohort engine simulates all the subjects and visits of a single cohort.
+# It is given the biology, the protocol and the protocol and biology parameters
+# of the cohort and returns two odicts of columns (one list / numpy array per
+# column of the subtab and visittab respectively):
+#   subCols: biol_id, prot_id, cohort_id, sub_id, the protocol's subject
+#       parameters and the biology's subject parameters
+#   visitCols: biol_id, prot_id, cohort_id, sub_id, visit_id, visit_date, bmv
+# simulateCohortScalar draws one subject and one visit at a time.
+# simulateCohortNumpy draws whole cohorts at a time using the _vec functions
+#   of the biologies and protocols where they exist.
+# }}}
+
+def appendRow(columns, header, row): # {{{
+    for key, value in zip(header, row):
+        if key not in columns:
+            columns[key] = []
+        columns[key].append(value)
+    #}}}
+
+def subParsColumns(sub_pars): # {{{
+    """
+    Turns a list of subject parameter odicts into an odict of numpy arrays
+    """
+    columns = odict()
+    for pars in sub_pars:
+        appendRow(columns, pars.keys(), pars.values())
+    for key in columns.keys():
+        columns[key] = np.array(columns[key])
+    return columns #}}}
+
+def selectRows(columns, mask): # {{{
+    selected = odict()
+    for key in columns.keys():
+        selected[key] = columns[key][mask]
+    return selected #}}}
+
+def subParsRow(columns, i): # {{{
+    """
+    The subject parameters of the i'th subject in an odict of columns
+    """
+    pars = odict()
+    for key in columns.keys():
+        pars[key] = columns[key][i]
+    return pars #}}}
+
+def simulateCohortScalar(biology, protocol, prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id, stream_key = None, sub_ids = None): # {{{
     """
-    Simulates all the data and saves it in MySQL
+    Simulates a cohort one subject and one visit at a time
+    If stream_key is given, every subject gets its own random number stream
+    keyed by stream_key + (sub_id,), so that any subject can be simulated
+    again on its own. sub_ids restricts the simulation to those subjects.
     """
+    bmf = biology['bmf_fun']
+    ff_sub_pars_gen = biology['sub_pars_gen']
+    prot_sub_pars_gen = protocol['sub_pars_gen']
+    prot_visit_pars_gen = protocol['visit_pars_gen']
+    biol_id = biology['biol_id']
+    prot_id = prot_prot_pars['prot_id']
+
+    subCols = odict()
+    visitCols = odict()
+    visitHeader = ["biol_id", "prot_id", "cohort_id", "sub_id", "visit_id", "visit_date", "bmv"]
+
+    if sub_ids is None:
+        sub_ids = range(prot_cohort_pars['cohort_sizes'])
+
+    for sub_id in sub_ids:
+        if sub_id >= prot_cohort_pars['cohort_sizes']:
+            continue
+        if stream_key is not None:
+            seedStreams(*(stream_key + (sub_id,)))
+
+        prot_sub_pars = prot_sub_pars_gen(prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id, sub_id)
+
+        ff_sub_pars = ff_sub_pars_gen(prot_prot_pars, prot_cohort_pars, prot_sub_pars, ff_cohort_pars, cohort_id, sub_id)
+
+        appendRow(subCols,
+                ["biol_id", "prot_id", "cohort_id", "sub_id"] + prot_sub_pars.keys() + ff_sub_pars.keys(),
+                [biol_id, prot_id, cohort_id, sub_id] + prot_sub_pars.values() + ff_sub_pars.values())
+
+        done = False
+        visit_id = -1
+        visits = []
+        while not done:
+            visit_id += 1
+            tmp = prot_visit_pars_gen(prot_prot_pars, 
+                    prot_cohort_pars, 
+                    ff_cohort_pars, 
+                    prot_sub_pars, 
+                    ff_sub_pars,
+                    visits, 
+                    cohort_id, 
+                    sub_id, 
+                    visit_id)
+            done = tmp[0]
+            tmp_visits = visits + [tmp[1]]
+            if tmp[1][2] == "missed":
+                pass
+            else:
+                bmv = bmf(ff_cohort_pars, 
+                        ff_sub_pars, 
+                        prot_cohort_pars, 
+                        prot_sub_pars, 
+                        tmp_visits)
+                tmp[1][2] = bmv
+                visits.append(tmp[1])
+                appendRow(visitCols, visitHeader, [biol_id, prot_id, cohort_id, sub_id]+tmp[1])
+    return subCols, visitCols
+    #}}}
+
+def simulateCohortNumpy(biology, protocol, prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id, stream_key = None, sub_ids = None): # {{{
+    """
+    Simulates a cohort with numpy arrays.
+    The subject parameters are drawn for the whole cohort at once, then
+    the visit dates of all the subjects are generated and lastly the
+    biomarker values of all the visits are computed in a single call.
+    Gives the same distribution of output as simulateCohortScalar
+    The subjects share the cohort's random number stream, so sub_ids
+    only filters the output: the whole cohort is still simulated.
+    """
+    biol_id = biology['biol_id']
+    prot_id = prot_prot_pars['prot_id']
+    nsubs = prot_cohort_pars['cohort_sizes']
+
+    if nsubs == 0:
+        return odict(), odict()
+
+    # Subject parameters {{{
+    if 'sub_pars_gen_vec' in protocol:
+        prot_sub_pars = protocol['sub_pars_gen_vec'](prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id, nsubs)
+    else:
+        prot_sub_pars = subParsColumns([protocol['sub_pars_gen'](prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id, sub_id)
+            for sub_id in range(nsubs)])
+
+    if 'sub_pars_gen_vec' in biology:
+        ff_sub_pars = biology['sub_pars_gen_vec'](prot_prot_pars, prot_cohort_pars, prot_sub_pars, ff_cohort_pars, cohort_id, nsubs)
+    else:
+        ff_sub_pars = subParsColumns([biology['sub_pars_gen'](prot_prot_pars, prot_cohort_pars, subParsRow(prot_sub_pars, sub_id), ff_cohort_pars, cohort_id, sub_id)
+            for sub_id in range(nsubs)])
+
+    subCols = odict()
+    subCols['biol_id'] = np.repeat(biol_id, nsubs)
+    subCols['prot_id'] = np.repeat(prot_id, nsubs)
+    subCols['cohort_id'] = np.repeat(cohort_id, nsubs)
+    subCols['sub_id'] = np.arange(nsubs)
+    subCols.update(prot_sub_pars)
+    subCols.update(ff_sub_pars)
+    #}}}
+
+    # Visits {{{
+    if protocol.get('bmv_dependent_visits'):
+        if 'visit_step_gen_vec' in protocol:
+            visits_gen = visitsLockStep
+        else:
+            visits_gen = visitsLoop
+        sub_idx, visit_ids, visit_dates, bmvs = visits_gen(biology, protocol, prot_prot_pars, prot_cohort_pars, ff_cohort_pars,
+                prot_sub_pars, ff_sub_pars, cohort_id, nsubs)
+    else:
+        if 'visit_schedule_gen_vec' in protocol:
+            sub_idx, visit_ids, visit_dates = protocol['visit_schedule_gen_vec'](prot_prot_pars, prot_cohort_pars, ff_cohort_pars,
+                    prot_sub_pars, ff_sub_pars, cohort_id, nsubs)
+        else:
+            sub_idx, visit_ids, visit_dates = visitDatesLoop(protocol, prot_prot_pars, prot_cohort_pars, ff_cohort_pars,
+                    prot_sub_pars, ff_sub_pars, cohort_id, nsubs)
+        bmvs = cohortBMV(biology, prot_cohort_pars, ff_cohort_pars, prot_sub_pars, ff_sub_pars,
+                sub_idx, visit_ids, visit_dates)
+
+    nvisits = len(sub_idx)
+    visitCols = odict()
+    visitCols['biol_id'] = np.repeat(biol_id, nvisits)
+    visitCols['prot_id'] = np.repeat(prot_id, nvisits)
+    visitCols['cohort_id'] = np.repeat(cohort_id, nvisits)
+    visitCols['sub_id'] = sub_idx
+    visitCols['visit_id'] = visit_ids
+    visitCols['visit_date'] = visit_dates
+    visitCols['bmv'] = bmvs
+    #}}}
+
+    if sub_ids is not None:
+        subCols = selectRows(subCols, np.in1d(subCols['sub_id'], sub_ids))
+        visitCols = selectRows(visitCols, np.in1d(visitCols['sub_id'], sub_ids))
+
+    return subCols, visitCols
+    #}}}
+
+def visitDatesLoop(protocol, prot_prot_pars, prot_cohort_pars, ff_cohort_pars, prot_sub_pars, ff_sub_pars, cohort_id, nsubs): # {{{
+    """
+    Generates the visit dates of every subject in a cohort by calling the
+    protocol's visit_pars_gen once per visit. The biomarker values are not
+    known yet, so the visits handed to visit_pars_gen have a bmv of None.
+    Returns the subject index, visit_id and visit_date of every realised visit
+    """
+    prot_visit_pars_gen = protocol['visit_pars_gen']
+    sub_idx = []
+    visit_ids = []
+    visit_dates = []
+    for sub_id in range(nsubs):
+        prot_sub_row = subParsRow(prot_sub_pars, sub_id)
+        ff_sub_row = subParsRow(ff_sub_pars, sub_id)
+        done = False
+        visit_id = -1
+        visits = []
+        while not done:
+            visit_id += 1
+            tmp = prot_visit_pars_gen(prot_prot_pars,
+                    prot_cohort_pars,
+                    ff_cohort_pars,
+                    prot_sub_row,
+                    ff_sub_row,
+                    visits,
+                    cohort_id,
+                    sub_id,
+                    visit_id)
+            done = tmp[0]
+            if tmp[1][2] != "missed":
+                visits.append(tmp[1])
+                sub_idx.append(sub_id)
+                visit_ids.append(tmp[1][0])
+                visit_dates.append(tmp[1][1])
+    return np.array(sub_idx, dtype = int), np.array(visit_ids, dtype = int), np.array(visit_dates, dtype = float)
+    #}}}
+
+def visitsLoop(biology, protocol, prot_prot_pars, prot_cohort_pars, ff_cohort_pars, prot_sub_pars, ff_sub_pars, cohort_id, nsubs): # {{{
+    """
+    Like visitDatesLoop, but computes the biomarker value of each visit
+    before the next visit is generated. Used for protocols whose visits
+    depend on the biomarker values
+    """
+    bmf = biology['bmf_fun']
+    prot_visit_pars_gen = protocol['visit_pars_gen']
+    sub_idx = []
+    visit_ids = []
+    visit_dates = []
+    bmvs = []
+    for sub_id in range(nsubs):
+        prot_sub_row = subParsRow(prot_sub_pars, sub_id)
+        ff_sub_row = subParsRow(ff_sub_pars, sub_id)
+        done = False
+        visit_id = -1
+        visits = []
+        while not done:
+            visit_id += 1
+            tmp = prot_visit_pars_gen(prot_prot_pars,
+                    prot_cohort_pars,
+                    ff_cohort_pars,
+                    prot_sub_row,
+                    ff_sub_row,
+                    visits,
+                    cohort_id,
+                    sub_id,
+                    visit_id)
+            done = tmp[0]
+            if tmp[1][2] != "missed":
+                tmp[1][2] = bmf(ff_cohort_pars, ff_sub_row, prot_cohort_pars, prot_sub_row, visits + [tmp[1]])
+                visits.append(tmp[1])
+                sub_idx.append(sub_id)
+                visit_ids.append(tmp[1][0])
+                visit_dates.append(tmp[1][1])
+                bmvs.append(tmp[1][2])
+    return (np.array(sub_idx, dtype = int), np.array(visit_ids, dtype = int),
+            np.array(visit_dates, dtype = float), np.array(bmvs, dtype = float))
+    #}}}
+
+def visitsLockStep(biology, protocol, prot_prot_pars, prot_cohort_pars, ff_cohort_pars, prot_sub_pars, ff_sub_pars, cohort_id, nsubs): # {{{
+    """
+    Like visitsLoop, but moves all the subjects of the cohort on together:
+    every step generates the next visit of all the subjects still in
+    follow-up with the protocol's visit_step_gen_vec, computes their
+    biomarker values with cohortBMV and drops the subjects whose visit was
+    their last. The biomarker functions only look at the last visit, so
+    this gives the same distribution of visits as visitsLoop.
+    """
+    visit_step_gen = protocol['visit_step_gen_vec']
+    active = np.arange(nsubs)
+    last_dates = np.repeat(np.nan, nsubs)
+    last_bmvs = np.repeat(np.nan, nsubs)
+    sub_idx = []
+    visit_ids = []
+    visit_dates = []
+    bmvs = []
+    visit_id = 0
+    while len(active) > 0:
+        done, dates = visit_step_gen(prot_prot_pars,
+                prot_cohort_pars,
+                ff_cohort_pars,
+                prot_sub_pars,
+                ff_sub_pars,
+                active,
+                last_dates,
+                last_bmvs,
+                cohort_id,
+                visit_id)
+        ids = np.repeat(visit_id, len(active))
+        values = cohortBMV(biology, prot_cohort_pars, ff_cohort_pars, prot_sub_pars, ff_sub_pars, active, ids, dates)
+        sub_idx.append(active)
+        visit_ids.append(ids)
+        visit_dates.append(dates)
+        bmvs.append(values)
+        active = active[~done]
+        last_dates = dates[~done]
+        last_bmvs = values[~done]
+        visit_id += 1
+    if visit_id == 0:
+        return (np.array([], dtype = int), np.array([], dtype = int),
+                np.array([], dtype = float), np.array([], dtype = float))
+    sub_idx = np.concatenate(sub_idx)
+    visit_ids = np.concatenate(visit_ids)
+    order = np.lexsort((visit_ids, sub_idx))
+    return (sub_idx[order], visit_ids[order],
+            np.concatenate(visit_dates)[order].astype(float), np.concatenate(bmvs)[order].astype(float))
+    #}}}
+
+def cohortBMV(biology, prot_cohort_pars, ff_cohort_pars, prot_sub_pars, ff_sub_pars, sub_idx, visit_ids, visit_dates): # {{{
+    """
+    Computes the biomarker values of all the visits in a cohort
+    sub_idx links every visit to its row in the subject parameter columns
+    """
+    if 'bmf_fun_vec' in biology:
+        prot_sub_vis = odict()
+        for key in prot_sub_pars.keys():
+            prot_sub_vis[key] = prot_sub_pars[key][sub_idx]
+        ff_sub_vis = odict()
+        for key in ff_sub_pars.keys():
+            ff_sub_vis[key] = ff_sub_pars[key][sub_idx]
+        return biology['bmf_fun_vec'](ff_cohort_pars, ff_sub_vis, prot_cohort_pars, prot_sub_vis, visit_dates)
+    else:
+        bmf = biology['bmf_fun']
+        bmvs = np.empty(len(sub_idx))
+        for i in range(len(sub_idx)):
+            bmvs[i] = bmf(ff_cohort_pars,
+                    subParsRow(ff_sub_pars, sub_idx[i]),
+                    prot_cohort_pars,
+                    subParsRow(prot_sub_pars, sub_idx[i]),
+                    [[visit_ids[i], visit_dates[i], None]])
+        return bmvs
+    #}}}
+
+cohortEnginesD = {'scalar': simulateCohortScalar,
+        'numpy': simulateCohortNumpy}
+
+#}}}
+
+# Running the cohort engines in parallel {{{
+
+# Description {{{
+# Every cohort is simulated by a task: a tuple of the engine, the index of the
+# biology and protocol in the lists handed to simulateCohorts, the protocol
+# and biology parameters of the cohort, the cohort_id and the key of the
+# cohort's random number stream. The parameters are loaded from the database
+# by the parent process, so the worker processes never touch the database.
+# Before a cohort is simulated both random and numpy.random are seeded from
+# the cohort's key, so a cohort gets the same random numbers no matter which
+# process simulates it or how many processes there are.
+# The key of a cohort's stream is (seed, biol_id, prot_id, prot_par_set,
+# biol_par_set, cohort_id) and the scalar engine gives each subject the stream
+# key + (sub_id,). A stream can be derived straight from its key, so any cohort
+# (or with the scalar engine any subject) can be simulated again without
+# simulating the ones before it: rerun with the same --seed and select it with
+# --cohorts / --subjects.
+# }}}
+
+def streamSeed(*key): # {{{
+    """
+    Derives the seed of an independent random number stream from a key
+    (the master seed followed by the identifiers of the stream).
+    Returns the seed as an array of 4 uint32s (128 bits) for numpy.random
+    and the same 128 bits as a long for random.
+    """
+    digest = hashlib.sha256("|".join([str(k) for k in key])).digest()[:16]
+    return np.frombuffer(digest, dtype = np.uint32), long(digest.encode('hex'), 16)
+    #}}}
+
+def seedStreams(*key): # {{{
+    np_seed, py_seed = streamSeed(*key)
+    np.random.seed(np_seed)
+    random.seed(py_seed)
+    #}}}
+
+def initCohortWorker(biologies, protocols): # {{{
+    global workerBiologies, workerProtocols
+    workerBiologies = biologies
+    workerProtocols = protocols
+    #}}}
+
+def roundVisitDateColumn(visitCols): # {{{
+    """
+    Rounds the visit dates of a cohort to whole days, like the
+    round(visit_date, 0) UPDATE that used to be run over the finished visit
+    table (numpy rounds halves to even, as MySQL does for doubles).
+    The biomarker values were computed from the exact dates.
+    """
+    if 'visit_date' in visitCols:
+        visitCols['visit_date'] = np.round(np.asarray(visitCols['visit_date'], dtype = float), 0)
+    return visitCols
+    #}}}
+
+def simulateCohortTask(task): # {{{
+    engine, biology_idx, protocol_idx, prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id, stream_key, sub_ids = task
+    seedStreams(*stream_key)
+    subCols, visitCols = cohortEnginesD[engine](workerBiologies[biology_idx], workerProtocols[protocol_idx],
+            prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id, stream_key, sub_ids)
+    # Only round visit dates if its not overwitten on the command line
+    if options.roundVisitDates:
+        roundVisitDateColumn(visitCols)
+    return subCols, visitCols
+    #}}}
+
+def runCohortTasks(pool, tasks, workers): # {{{
+    """
+    Yields the results of the tasks in the order of the tasks.
+    With a pool, only a few tasks per worker are handed out at a time so
+    that finished cohorts do not pile up in memory while they are written
+    """
+    if pool is None:
+        for task in tasks:
+            yield simulateCohortTask(task)
+    else:
+        chunk = 4 * workers
+        for start in range(0, len(tasks), chunk):
+            for result in pool.imap(simulateCohortTask, tasks[start:start+chunk]):
+                yield result
+    #}}}
+
+#}}}
+
+def simulateCohorts(biologies, biolParSets, protocols, protParSets, ncohorts_input = -1, engine = "scalar", batch_size = 1000, sink = "insert", workers = 1, seed = None, cohort_ids = None, sub_ids = None, out_dir = None, compress = None): # {{{
+    """
+    Simulates all the data and saves it with the storage backend
+    sinksD[sink] (MySQL by default)
+    """
+    writer = sinksD[sink](batch_size, out_dir, compress)
     runid = "run_" + datetime.datetime.now().strftime("%Y_%m_%d_%H_%M") + "_" + "".join([str(random.randint(0,9)) for i in range(4)])
     print "runid:", runid
-    for biology in biologies:
-        bmf = biology['bmf_fun']
-        ff_cohort_pars_gen = biology['cohort_pars_gen']
-        ff_sub_pars_gen = biology['sub_pars_gen']
-        biol_id = biology['biol_id']
-        biol_version = biology['version']
-        print "!"*50
-        print "biol", biol_id
-        print "!"*50
+    if seed is None:
+        seed = random.SystemRandom().randint(0, 2**32 - 1)
+    print "seed:", seed
+
+    try:
+        initCohortWorker(biologies, protocols)
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initCohortWorker, (biologies, protocols))
+        else:
+            pool = None
+
+        for biology_idx, biology in enumerate(biologies):
+            ff_cohort_pars_gen = biology['cohort_pars_gen']
+            biol_id = biology['biol_id']
+            biol_version = biology['version']
+            print "!"*50
+            print "biol", biol_id
+            print "!"*50
     
-        for protocol in protocols:
-            prot_prot_pars_gen = protocol['prot_pars_gen']
-            prot_cohort_pars_gen = protocol['cohort_pars_gen']
-            prot_sub_pars_gen = protocol['sub_pars_gen']
-            prot_visit_pars_gen = protocol['visit_pars_gen']
+            for protocol_idx, protocol in enumerate(protocols):
+                prot_prot_pars_gen = protocol['prot_pars_gen']
+                prot_cohort_pars_gen = protocol['cohort_pars_gen']
     
-            prot_prot_pars = prot_prot_pars_gen()
-            prot_id = prot_prot_pars['prot_id']
-            prot_version = prot_prot_pars['prot_version']
+                prot_prot_pars = prot_prot_pars_gen()
+                prot_id = prot_prot_pars['prot_id']
+                prot_version = prot_prot_pars['prot_version']
     
-            print "-"*50
-            print "prot", prot_id
-            print "-"*50
+                print "-"*50
+                print "prot", prot_id
+                print "-"*50
     
-            cohortTab = False
-            subTab = False
-            visitTab = False
+                cohortTab = False
+                subTab = False
+                visitTab = False
 
-            if ncohorts_input != -1:
-                prot_prot_pars['ncohorts'] = ncohorts_input
-                print "ncohorts overwritten with user input"
+                if ncohorts_input != -1:
+                    prot_prot_pars['ncohorts'] = ncohorts_input
+                    print "ncohorts overwritten with user input"
     
-            protTabName = runid+"_prottab_" + str(biol_id) + "_" + str(prot_id)
-            qstring = createTable(protTabName, 
-                    ["biol_id"] + prot_prot_pars.keys() + ['biol_version'])
-            con.execute(qstring)
-            protTab = True
-            qstring = insertData(name = protTabName,
-                    data = [biol_id] + prot_prot_pars.values() + [biol_version])
-            con.execute(qstring)
-            db.commit()
-
-            cohort_id = -1
-            for prot_par_set in protParSets[prot_id]:
-                for biol_par_set in biolParSets[biol_id]:
-                    for cohort_counter in range(prot_prot_pars['ncohorts']):
-                        cohort_id += 1
-                        print "cohort", cohort_id, "  -><-  ",
-                        
-                        prot_cohort_pars = prot_cohort_pars_gen(prot_prot_pars, prot_par_set)
-            
-                        ff_cohort_pars = ff_cohort_pars_gen(prot_prot_pars, prot_cohort_pars, biol_par_set, biol_version, biol_id)
-            
-                        if not cohortTab:
-                            cohortTabName = runid+"_cohorttab_" + str(biol_id) + "_" +str(prot_id)
-                            qstring = createTable(cohortTabName, 
-                                    ["biol_id", "prot_id", "cohort_id"] + prot_cohort_pars.keys() + ff_cohort_pars.keys())
-                            con.execute(qstring)
-                            cohortTab = True
-                        #print [biol_id, prot_id, cohort_id] + prot_cohort_pars.values() + ff_cohort_pars.values()
-                        qstring = insertData(name = cohortTabName,
-                                data = [biol_id, prot_id, cohort_id] + prot_cohort_pars.values() + ff_cohort_pars.values())
-                        con.execute(qstring)
-                        db.commit()
-#                        f = open('/tmp/sim2nd.log.tmp','a')
-#                        f.writelines(str(prot_cohort_pars)+'\n')
-#                        f.close()
-                        
-                        for sub_id in range(prot_cohort_pars['cohort_sizes']):
-                            
-                            prot_sub_pars = prot_sub_pars_gen(prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id, sub_id)
+                protTabName = runid+"_prottab_" + str(biol_id) + "_" + str(prot_id)
+                writer.create_table(protTabName, 
+                        ["biol_id"] + prot_prot_pars.keys() + ['biol_version'])
+                protTab = True
+                writer.insert_row(protTabName,
+                        [biol_id] + prot_prot_pars.values() + [biol_version])
+                writer.commit()
+
+                tasks = []
+                cohort_id = -1
+                for prot_par_set in protParSets[prot_id]:
+                    for biol_par_set in biolParSets[biol_id]:
+                        for cohort_counter in range(prot_prot_pars['ncohorts']):
+                            cohort_id += 1
+                            if cohort_ids is not None and cohort_id not in cohort_ids:
+                                continue
+                            prot_cohort_pars = prot_cohort_pars_gen(prot_prot_pars, prot_par_set)
+                            ff_cohort_pars = ff_cohort_pars_gen(prot_prot_pars, prot_cohort_pars, biol_par_set, biol_version, biol_id)
+                            tasks.append((engine, biology_idx, protocol_idx, prot_prot_pars, prot_cohort_pars, ff_cohort_pars, cohort_id,
+                                (seed, biol_id, prot_id, prot_par_set, biol_par_set, cohort_id), sub_ids))
+
+                for task, (subCols, visitCols) in itertools.izip(tasks, runCohortTasks(pool, tasks, workers)):
+                    prot_cohort_pars, ff_cohort_pars, cohort_id = task[4:7]
+                    print "cohort", cohort_id, "  -><-  ",
             
-                            ff_sub_pars = ff_sub_pars_gen(prot_prot_pars, prot_cohort_pars, prot_sub_pars, ff_cohort_pars, cohort_id, sub_id)
-                            
-                            if not subTab:
-                                subTabName = runid+"_subtab_" + str(biol_id) + "_" + str(prot_id)
-                                qstring = createTable(subTabName, 
-                                        ["biol_id", "prot_id", "cohort_id", "sub_id"] + prot_sub_pars.keys() + ff_sub_pars.keys())
-                                con.execute(qstring)
-                                subTab = True
-                            qstring = insertData(name = subTabName,
-                                    data = [biol_id, prot_id, cohort_id, sub_id] + prot_sub_pars.values() + ff_sub_pars.values())
-                            con.execute(qstring)
-             
-                            done = False
-                            visit_id = -1
-                            visits = []
-                            while not done:
-                                if not visitTab:
-                                    visitTabName = runid+"_visittab_" + str(biol_id) + "_" + str(prot_id)
-                                    qstring = createTable(visitTabName, 
-                                            ["biol_id", "prot_id", "cohort_id", "sub_id", "visit_id", "visit_date", "bmv"])
-                                    con.execute(qstring)
-                                    visitTab = True
-                                visit_id += 1
-                                tmp = prot_visit_pars_gen(prot_prot_pars, 
-                                        prot_cohort_pars, 
-                                        ff_cohort_pars, 
-                                        prot_sub_pars, 
-                                        ff_sub_pars,
-                                        visits, 
-                                        cohort_id, 
-                                        sub_id, 
-                                        visit_id)
-#                                f = open("/tmp/mysql_sim_2nd.log","a")
-#                                f.writelines(str(tmp)+'\n')
-#                                f.close()
-                                done = tmp[0]
-                                tmp_visits = visits + [tmp[1]]
-                                if tmp[1][2] == "missed":
-                                    pass
-                                else:
-                                    bmv = bmf(ff_cohort_pars, 
-                                            ff_sub_pars, 
-                                            prot_cohort_pars, 
-                                            prot_sub_pars, 
-                                            tmp_visits)
-                                    tmp[1][2] = bmv
-                                    visits.append(tmp[1])
-                
-                                    qstring = insertData(name = visitTabName,
-                                            data = [biol_id, prot_id, cohort_id, sub_id]+tmp[1])
-                                    #f = open("/tmp/mysql_sim_2nd.log","a")
-                                    #f.writelines(qstring+'\n')
-                                    #f.close()
-                                    con.execute(qstring)
-    # Only round visit dates if its not overwitten on the command line
-    qstring = roundVisitDates(visitTabName, options.roundVisitDates)
-    con.execute(qstring)
-    db.commit()
+                    if not cohortTab:
+                        cohortTabName = runid+"_cohorttab_" + str(biol_id) + "_" +str(prot_id)
+                        writer.create_table(cohortTabName, 
+                                ["biol_id", "prot_id", "cohort_id"] + prot_cohort_pars.keys() + ff_cohort_pars.keys())
+                        cohortTab = True
+                    writer.insert_row(cohortTabName,
+                            [biol_id, prot_id, cohort_id] + prot_cohort_pars.values() + ff_cohort_pars.values())
+
+                    if len(subCols) == 0:
+                        writer.commit()
+                        continue
+
+                    if not subTab:
+                        subTabName = runid+"_subtab_" + str(biol_id) + "_" + str(prot_id)
+                        writer.create_table(subTabName, subCols.keys())
+                        subTab = True
+                    writer.insert_rows(subTabName, iterRows(subCols))
+
+                    if not visitTab:
+                        visitTabName = runid+"_visittab_" + str(biol_id) + "_" + str(prot_id)
+                        writer.create_table(visitTabName, 
+                                ["biol_id", "prot_id", "cohort_id", "sub_id", "visit_id", "visit_date", "bmv"])
+                        visitTab = True
+                    writer.insert_rows(visitTabName, iterRows(visitCols))
+                    writer.commit()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        writer.finish()
+    finally:
+        writer.cleanup()
     print "Success"
     return 0
     #}}}
@@ -2282,6 +4072,21 @@ def exactSolutions(biologies, biolParSets, method, threshold, bigT): #{{{
     # }}}
 
 # prep protocols and biologies {{{
+def parseIdList(ids):
+    """
+    '1,4-6' -> [1, 4, 5, 6]
+    """
+    if ids is None:
+        return None
+    result = []
+    for part in ids.split(','):
+        if part.count('-') > 0:
+            first, last = part.split('-')
+            result += range(int(first), int(last) + 1)
+        else:
+            result.append(int(part))
+    return sorted(set(result))
+
 biologies = []
 biolParamSets = {}
 if options.reqBiologies != None:
@@ -2350,5 +4155,7 @@ if options.command == "exact":
     print('WARNING computation of exact solutions are buggy - rather use R')
     exactSolutions(biologies, biolParamSets, options.integration_method, options.threshold, options.bigT)
 elif options.command == "sims":
-    simulateCohorts(biologies, biolParamSets, protocols, protParamSets, int(options.ncohorts_input))
+    simulateCohorts(biologies, biolParamSets, protocols, protParamSets, int(options.ncohorts_input), options.engine, options.batch_size, options.sink, options.workers,
+            options.seed, parseIdList(options.cohorts), parseIdList(options.subjects), options.out_dir,
+            options.compress)
 # }}}
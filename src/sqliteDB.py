@@ -0,0 +1,197 @@
+# Embedded SQLite stand-in for the assay_calib_sims MySQL database.
+# simulator.py, dbToFile.py and par_set_cloner.py use this when they are
+# given --sqlite=<file>. If the file does not exist yet it is created and
+# seeded from the MySQL dump acs_no_sims_20150810.sql (the parameter set
+# tables without any simulation runs).
+# The connection and cursor objects mimic the parts of MySQLdb that the
+# scripts use, and the cursor translates the MySQL dialect in their queries:
+#   %s placeholders, "double quoted" strings, Engine = InnoDB,
+#   describe <table>, CREATE INDEX / ALTER TABLE ... ADD INDEX,
+#   CREATE TABLE <name> SELECT ..., SELECT ... INTO OUTFILE and
+#   LOAD DATA LOCAL INFILE.
+# example call: python simulator.py --sqlite=acs.sqlite -c sims -p "prot3.1m_1m_19_10" -b "biology2.noise_015_bed" -n 10
+
+import os
+import re
+import sqlite3
+
+defaultDump = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'acs_no_sims_20150810.sql')
+
+Error = sqlite3.Error
+
+def dumpStatements(dump): #{{{
+    """
+    Splits a mysqldump file into statements sqlite can execute
+    """
+    f = open(dump)
+    text = f.read()
+    f.close()
+    statements = []
+    for stmt in re.split(r';\s*\n', text):
+        stmt = re.sub(r'/\*!.*?\*/', '', stmt, flags = re.S)
+        stmt = "\n".join([l for l in stmt.split("\n") if not l.startswith("--")]).strip()
+        if stmt == "" or stmt.startswith("LOCK") or stmt.startswith("UNLOCK"):
+            continue
+        stmt = re.sub(r'\)\s*ENGINE\s*=.*$', ')', stmt, flags = re.S | re.I)
+        stmt = re.sub(r',\s*(PRIMARY |UNIQUE )?KEY [^\n]*(?=\n)', '', stmt)
+        stmt = stmt.replace("\\'", "''")
+        statements.append(stmt)
+    return statements #}}}
+
+def quoteStrings(query): #{{{
+    """
+    MySQL reads "x" as a string, sqlite as an identifier
+    """
+    def requote(m):
+        if m.group(1) is None:
+            return m.group(0)
+        return "'" + m.group(1).replace("'", "''") + "'"
+    return re.sub(r"'(?:[^'\\]|\\.|'')*'|\"((?:[^\"\\]|\\.)*)\"", requote, query) #}}}
+
+def nullField(x):
+    if x == "\\N":
+        return None
+    else:
+        return x
+
+def outfileField(x):
+    if x is None:
+        return "\\N"
+    elif isinstance(x, float):
+        return repr(x)
+    else:
+        return str(x)
+
+class SQLiteCursor(object): #{{{
+
+    def __init__(self, con):
+        self.con = con
+        self.cur = con.cursor()
+        self.rows = None
+
+    def translate(self, query):#{{{
+        query = quoteStrings(query)
+        query = re.sub(r'\)\s*Engine\s*=\s*InnoDB', ')', query, flags = re.I)
+        # index names are global in sqlite but per table in MySQL
+        query = re.sub(r'^\s*CREATE INDEX (\w+) ON (\w+)',
+                r'CREATE INDEX \2_\1 ON \2', query, flags = re.I)
+        query = re.sub(r'^\s*ALTER TABLE (\w+) ADD INDEX `?(\w+)`?',
+                r'CREATE INDEX \1_\2 ON \1', query, flags = re.I)
+        query = re.sub(r'^(\s*CREATE TABLE (?:IF NOT EXISTS )?\w+)\s+SELECT',
+                r'\1 AS SELECT', query, flags = re.I)
+        return query
+        #}}}
+
+    def execute(self, query, args = None):#{{{
+        self.rows = None
+        m = re.match(r"\s*describe\s+`?(\w+)`?\s*$", query, flags = re.I)
+        if m:
+            self.cur.execute("PRAGMA table_info(%s)" %m.group(1))
+            self.rows = [(r[1], r[2], r[3] == 0 and "YES" or "NO", "", r[4], "") for r in self.cur.fetchall()]
+            return len(self.rows)
+        m = re.match(r"\s*LOAD DATA LOCAL INFILE '([^']*)' INTO TABLE (\w+)", query, flags = re.I)
+        if m:
+            return self.load_data(m.group(1), m.group(2))
+        m = re.match(r"(.*)\s+into outfile\s+'([^']*)'", query, flags = re.I | re.S)
+        if m:
+            return self.into_outfile(m.group(1), m.group(2))
+        query = self.translate(query)
+        if args is None:
+            self.cur.execute(query)
+        else:
+            self.cur.execute(query.replace("%s", "?"), args)
+        return self.cur.rowcount
+        #}}}
+
+    def executemany(self, query, args):#{{{
+        self.rows = None
+        self.cur.executemany(self.translate(query).replace("%s", "?"), args)
+        return self.cur.rowcount
+        #}}}
+
+    def load_data(self, path, table):#{{{
+        f = open(path)
+        rows = [[nullField(x) for x in line.rstrip("\n").split("|")] for line in f]
+        f.close()
+        if len(rows) > 0:
+            self.cur.executemany("INSERT INTO %s VALUES (%s)" %(table, ",".join(["?"]*len(rows[0]))), rows)
+        return len(rows)
+        #}}}
+
+    def into_outfile(self, query, path):#{{{
+        if os.path.exists(path):
+            raise Error("File '%s' already exists" %path)
+        self.cur.execute(self.translate(query))
+        f = open(path, 'w')
+        n = 0
+        while True:
+            rows = self.cur.fetchmany(10000)
+            if len(rows) == 0:
+                break
+            f.writelines(["|".join([outfileField(x) for x in row]) + "\n" for row in rows])
+            n += len(rows)
+        f.close()
+        return n
+        #}}}
+
+    def fetchall(self):#{{{
+        if self.rows is not None:
+            rows, self.rows = self.rows, []
+            return rows
+        return self.cur.fetchall()
+        #}}}
+
+    def fetchone(self):#{{{
+        if self.rows is not None:
+            if len(self.rows) == 0:
+                return None
+            return self.rows.pop(0)
+        return self.cur.fetchone()
+        #}}}
+
+    def fetchmany(self, size = 1):#{{{
+        if self.rows is not None:
+            rows, self.rows = self.rows[:size], self.rows[size:]
+            return rows
+        return self.cur.fetchmany(size)
+        #}}}
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self.cur.close()
+    #}}}
+
+class SQLiteConnection(object): #{{{
+
+    def __init__(self, path, dump = None):
+        seed = path == ":memory:" or not os.path.exists(path)
+        self.con = sqlite3.connect(path)
+        self.con.text_factory = str
+        if seed:
+            if dump is None:
+                dump = defaultDump
+            for stmt in dumpStatements(dump):
+                self.con.execute(stmt)
+            self.con.commit()
+
+    def cursor(self):
+        return SQLiteCursor(self.con)
+
+    def commit(self):
+        self.con.commit()
+
+    def rollback(self):
+        self.con.rollback()
+
+    def close(self):
+        self.con.close()
+    #}}}
+
+def connect(path, dump = None):
+    """
+    Opens the sqlite database in path, seeding it from the MySQL dump
+    (acs_no_sims_20150810.sql by default) if it does not exist yet
+    """
+    return SQLiteConnection(path, dump)
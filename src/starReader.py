@@ -0,0 +1,102 @@
+# Reads the star schema written by dbToFile.py --star and joins it back
+# into the rows of the train file.
+# The cohorts and subjects files are small and are loaded into memory the
+# first time the rows are read; the visits file is streamed and every visit
+# is joined to its cohort and subject as it is read, so a train file never
+# has to be written to disk.
+# The files may be gzip or zstd compressed (dbToFile.py --compress); the
+# format is detected from the files.
+# example call: python starReader.py -d /tmp/2015_08_10_19_34_7597 -b 2_3 > train2_3.txt
+# or from python:
+#   import starReader
+#   run = starReader.StarRun('/tmp/2015_08_10_19_34_7597', '2_3')
+#   for row in run:
+#       ...  # row is a list of strings in the order of run.header
+
+import os
+import sys
+from optparse import OptionParser
+from compressedFiles import findInput, openInput
+
+id_cols = ['biol_id', 'prot_id', 'cohort_id', 'sub_id', 'visit_id']
+
+def readTable(path): #{{{
+    """
+    Returns the header of a pipe delimited file and an iterator over its
+    rows as lists of strings
+    """
+    f = openInput(path)
+    header = f.readline().rstrip("\n").split("|")
+    def rows():
+        for line in f:
+            yield line.rstrip("\n").split("|")
+        f.close()
+    return header, rows()
+    #}}}
+
+def readHeader(path): #{{{
+    f = openInput(path)
+    header = f.readline().rstrip("\n").split("|")
+    f.close()
+    return header
+    #}}}
+
+def loadKeyed(path, nkeys): #{{{
+    """
+    Loads a cohorts or subjects file into a dictionary from the tuple of its
+    first nkeys (id) columns to the rest of the row
+    """
+    header, rows = readTable(path)
+    table = {}
+    for row in rows:
+        table[tuple(row[:nkeys])] = row[nkeys:]
+    return header[nkeys:], table
+    #}}}
+
+class StarRun(object): #{{{
+    """
+    The train rows of one biology/protocol pair (fp is '<biol_id>_<prot_id>')
+    of a run exported with dbToFile.py --star to directory
+    """
+
+    def __init__(self, directory, fp):
+        self.cohorts_path = findInput(os.path.join(directory, 'cohorts%s.txt' %fp))
+        self.subjects_path = findInput(os.path.join(directory, 'subjects%s.txt' %fp))
+        self.visits_path = findInput(os.path.join(directory, 'visits%s.txt' %fp))
+        self.cohorts = None
+        self.subjects = None
+        self.header = (id_cols + readHeader(self.cohorts_path)[3:] +
+                readHeader(self.subjects_path)[4:] + readHeader(self.visits_path)[5:])
+
+    def load(self):#{{{
+        if self.cohorts is None:
+            self.cohorts = loadKeyed(self.cohorts_path, 3)[1]
+            self.subjects = loadKeyed(self.subjects_path, 4)[1]
+        #}}}
+
+    def __iter__(self):#{{{
+        self.load()
+        header, visits = readTable(self.visits_path)
+        for visit in visits:
+            yield (visit[:5] + self.cohorts[tuple(visit[:3])] +
+                    self.subjects[tuple(visit[:4])] + visit[5:])
+        #}}}
+
+    def write_train(self, f):#{{{
+        """
+        Writes the joined rows to the open file f in the train file format
+        """
+        f.write("|".join(self.header) + "\n")
+        for row in self:
+            f.write("|".join(row) + "\n")
+        #}}}
+    #}}}
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-d", "--directory", dest="directory",
+            help="directory with the cohorts, subjects and visits files of the run")
+    parser.add_option("-b", "--bio_prot", dest="bio_prot",
+            help="which biology_protocol pair to read (e.g. 2_3)")
+    (options, args) = parser.parse_args()
+    StarRun(options.directory, options.bio_prot).write_train(sys.stdout)
@@ -0,0 +1,119 @@
+# A sidecar index for train files: for every subject the byte offset of its
+# first row and its number of rows, so a reader can seek straight to any
+# cohort or subject instead of scanning the file from the top.
+# The index of train2_3.txt is train2_3.txt.idx, a pipe delimited file
+#   cohort_id|sub_id|offset|bytes|rows
+# It is written by dbToFile.py --index and by the 'train' sink of
+# simulator.py. The rows of a subject must be contiguous in the train file
+# and the file must not be compressed.
+# example:
+#   import trainIndex
+#   train = trainIndex.IndexedTrainFile('/tmp/2015_08_10_19_34_7597/train2_3.txt')
+#   for cohort_id in train.cohort_ids():
+#       rows = train.read_cohort(cohort_id)   # lists of strings, see train.header
+
+from collections import OrderedDict
+
+indexSuffix = ".idx"
+
+class TrainIndexWriter(object): #{{{
+    """
+    Builds the index of a train file while it is written: call add for every
+    row with its ids and its length in bytes, in the order the rows are
+    written. offset is the size of the header line.
+    """
+
+    def __init__(self, train_path, offset):
+        self.f = open(train_path + indexSuffix, 'w')
+        self.f.write("cohort_id|sub_id|offset|bytes|rows\n")
+        self.offset = offset
+        self.key = None
+        self.start = offset
+        self.nrows = 0
+        self.seen = set()
+
+    def add(self, cohort_id, sub_id, nbytes):#{{{
+        key = (cohort_id, sub_id)
+        if key != self.key:
+            self.write_entry()
+            if key in self.seen:
+                raise ValueError("The rows of cohort %s subject %s are not contiguous" %key)
+            self.seen.add(key)
+            self.key = key
+            self.start = self.offset
+            self.nrows = 0
+        self.offset += nbytes
+        self.nrows += 1
+        #}}}
+
+    def write_entry(self):#{{{
+        if self.key is not None:
+            self.f.write("%s|%s|%d|%d|%d\n" %(self.key[0], self.key[1],
+                self.start, self.offset - self.start, self.nrows))
+        #}}}
+
+    def close(self):#{{{
+        self.write_entry()
+        self.f.close()
+        #}}}
+    #}}}
+
+class IndexedTrainFile(object): #{{{
+    """
+    Random access to the cohorts and subjects of an indexed train file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.header = self.f.readline().rstrip("\n").split("|")
+        # cohort_id -> OrderedDict sub_id -> (offset, bytes, rows)
+        self.index = OrderedDict()
+        f = open(path + indexSuffix)
+        f.readline()
+        for line in f:
+            cohort_id, sub_id, offset, nbytes, nrows = [int(x) for x in line.rstrip("\n").split("|")]
+            self.index.setdefault(cohort_id, OrderedDict())[sub_id] = (offset, nbytes, nrows)
+        f.close()
+
+    def cohort_ids(self):#{{{
+        return self.index.keys()
+        #}}}
+
+    def sub_ids(self, cohort_id):#{{{
+        return self.index[cohort_id].keys()
+        #}}}
+
+    def cohort_rows(self, cohort_id):#{{{
+        return sum(nrows for offset, nbytes, nrows in self.index[cohort_id].values())
+        #}}}
+
+    def read_block(self, offset, nbytes):#{{{
+        self.f.seek(offset)
+        return [line.split("|") for line in self.f.read(nbytes).rstrip("\n").split("\n")]
+        #}}}
+
+    def read_subject(self, cohort_id, sub_id):#{{{
+        offset, nbytes, nrows = self.index[cohort_id][sub_id]
+        return self.read_block(offset, nbytes)
+        #}}}
+
+    def read_cohort(self, cohort_id):#{{{
+        """
+        The rows of all the subjects of the cohort. The subjects of a cohort
+        are normally next to each other in the file and are read in one go.
+        """
+        rows = []
+        start = end = None
+        for offset, nbytes, nrows in sorted(self.index[cohort_id].values()):
+            if offset != end:
+                if start is not None:
+                    rows += self.read_block(start, end - start)
+                start = offset
+            end = offset + nbytes
+        return rows + self.read_block(start, end - start)
+        #}}}
+
+    def close(self):
+        self.f.close()
+    #}}}
@@ -0,0 +1,109 @@
+# Reads the pipe delimited train and test files of dbToFile.py and
+# simulator.py --sink train into typed numpy structured arrays.
+# The lines are read and converted in blocks of rows, a column at a time,
+# instead of being split and converted a field at a time. The column types
+# are those of columnStore.columnType: *id columns are integers, versions,
+# parameter set names and the string parameters (e.g. dist of biology 4) are
+# strings and everything else is a double (\N becomes nan). The string
+# parameters are the varchar parameters of the parameter sets in the dump
+# the sqlite databases are seeded from, pass string_columns =
+# columnStore.stringParameters(cursor) for the parameter sets of another
+# database. gzip and zstd compressed files are read too.
+# example:
+#   import trainReader
+#   for cohort_id, rows in trainReader.iterCohorts('/tmp/2015_08_10_19_34_7597/train2_3.txt'):
+#       rows['bmv'], rows['visit_date'], rows['sub_id'] ...
+# rows.view(numpy.recarray) gives attribute access (rows.bmv).
+
+import itertools
+import numpy as np
+from compressedFiles import openInput
+from columnStore import columnType, dumpStringParameters
+
+blockRows = 100000
+
+def readHeader(f): #{{{
+    return f.readline().rstrip("\n").split("|")
+    #}}}
+
+def rowDtype(header, string_columns = None): #{{{
+    """
+    The structured dtype of the rows of a file with this header
+    """
+    if string_columns is None:
+        string_columns = dumpStringParameters()
+    return np.dtype([(name, columnType(name, string_columns)) for name in header])
+    #}}}
+
+def parseBlock(lines, dtype): #{{{
+    """
+    Converts a list of lines into a structured array of dtype
+    """
+    fields = np.array([line.rstrip("\n").split("|") for line in lines], dtype = str)
+    if fields.ndim != 2 or fields.shape[1] != len(dtype.names):
+        raise ValueError("Expected %d columns per row" %len(dtype.names))
+    rows = np.empty(len(lines), dtype = dtype)
+    for i, name in enumerate(dtype.names):
+        column = fields[:, i]
+        if dtype[name].kind == 'f':
+            column = np.where(column == "\\N", "nan", column)
+        rows[name] = column.astype(dtype[name])
+    return rows
+    #}}}
+
+def readBlocks(path, block_rows = blockRows, string_columns = None): #{{{
+    """
+    Yields the rows of a train or test file as structured arrays of at most
+    block_rows rows
+    """
+    f = openInput(path)
+    dtype = rowDtype(readHeader(f), string_columns)
+    lines = iter(f)
+    while True:
+        block = list(itertools.islice(lines, block_rows))
+        if len(block) == 0:
+            break
+        yield parseBlock(block, dtype)
+    f.close()
+    #}}}
+
+def readFile(path, block_rows = blockRows, string_columns = None): #{{{
+    """
+    All the rows of a train or test file in one structured array
+    """
+    blocks = list(readBlocks(path, block_rows, string_columns))
+    if len(blocks) == 0:
+        f = openInput(path)
+        dtype = rowDtype(readHeader(f), string_columns)
+        f.close()
+        return np.empty(0, dtype = dtype)
+    return np.concatenate(blocks)
+    #}}}
+
+def iterCohorts(path, block_rows = blockRows, string_columns = None): #{{{
+    """
+    Yields (cohort_id, rows) for one cohort at a time, so only a block and
+    a cohort are in memory. The rows of a cohort must be next to each other
+    in the file, as they are in the files of simulator.py --sink train and
+    dbToFile.py --index.
+    """
+    pending = None
+    seen = set()
+    for block in readBlocks(path, block_rows, string_columns):
+        cohort_ids = block['cohort_id']
+        starts = [0] + list(np.flatnonzero(cohort_ids[1:] != cohort_ids[:-1]) + 1) + [len(block)]
+        for start, end in zip(starts[:-1], starts[1:]):
+            rows = block[start:end]
+            cohort_id = int(rows['cohort_id'][0])
+            if pending is not None and int(pending['cohort_id'][0]) == cohort_id:
+                pending = np.concatenate([pending, rows])
+                continue
+            if pending is not None:
+                yield int(pending['cohort_id'][0]), pending
+            if cohort_id in seen:
+                raise ValueError("The rows of cohort %d are not contiguous" %cohort_id)
+            seen.add(cohort_id)
+            pending = rows
+    if pending is not None:
+        yield int(pending['cohort_id'][0]), pending
+    #}}}